@@ -0,0 +1,273 @@
+import argparse
+import json
+import logging
+import os
+import string
+import sys
+import time
+import numpy as np
+import main
+import utils
+from instrumentation import instrumentation
+from constants import NAVIGABLE_CELL, OBSTACLE_CELL, SHELVE_CELL
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger, logging_level=logging.INFO)
+
+BENCHMARK_BASELINES_FILE_FORMAT_VERSION = '1.0'
+
+# Each scenario is a warehouse layout (None for warehouse.json) and an order profile
+BENCHMARK_SCENARIOS = [
+    {
+        'name': 'gt-library',
+        'warehouse': None,
+        'booksPerPickPath': 10,
+        'popularitySkew': 0.0,
+    },
+    {
+        'name': 'small-uniform',
+        'warehouse': {'aislePairs': 4, 'shelvesPerAisle': 6, 'numberOfBooks': 300},
+        'booksPerPickPath': 10,
+        'popularitySkew': 0.0,
+    },
+    {
+        'name': 'medium-skewed',
+        'warehouse': {'aislePairs': 6, 'shelvesPerAisle': 12, 'numberOfBooks': 5000},
+        'booksPerPickPath': 15,
+        'popularitySkew': 1.0,
+    },
+    {
+        'name': 'large-uniform',
+        'warehouse': {'aislePairs': 10, 'shelvesPerAisle': 20, 'numberOfBooks': 50000},
+        'booksPerPickPath': 12,
+        'popularitySkew': 0.0,
+    },
+    {
+        'name': 'large-bulk-orders',
+        'warehouse': {'aislePairs': 10, 'shelvesPerAisle': 20, 'numberOfBooks': 50000},
+        'booksPerPickPath': 100,
+        'popularitySkew': 0.5,
+    },
+]
+
+
+def generate_synthetic_warehouse_data(aisle_pairs, shelves_per_aisle, number_of_books, aisle_width=4,
+                                      cross_aisle_width=5, seed=0):
+    """
+    Generates a version 1.1 warehouse JSON layout shaped like the GT library: blocks of two back-to-back aisles of
+    shelves (A facing up and B facing down, then C and D, ...), separated by corridors aisle_width cells wide, with
+    cross-aisles cross_aisle_width cells wide on both sides. The books are spread over the shelves at random.
+    """
+
+    assert 1 <= aisle_pairs <= len(string.ascii_uppercase) // 2
+
+    block_height = 4
+    block_width = 3 * shelves_per_aisle + 1
+
+    num_rows = aisle_width + aisle_pairs * (block_height + aisle_width)
+    num_cols = 2 * cross_aisle_width + block_width
+
+    navigation_grid = [[NAVIGABLE_CELL] * num_cols for _ in range(num_rows)]
+    shelve_tags_to_locations = {}
+
+    for block in range(aisle_pairs):
+        top_r = aisle_width + block * (block_height + aisle_width)
+        top_aisle, bottom_aisle = string.ascii_uppercase[2 * block], string.ascii_uppercase[2 * block + 1]
+
+        for r in range(top_r, top_r + block_height):
+            for c in range(cross_aisle_width, cross_aisle_width + block_width):
+                navigation_grid[r][c] = OBSTACLE_CELL
+
+        for k in range(shelves_per_aisle):
+            c = cross_aisle_width + 1 + 3 * k
+
+            # Like in the GT library, shelve columns count down even numbers on top and odd numbers at the bottom
+            column_number = 100 + 2 * (shelves_per_aisle - 1 - k)
+
+            navigation_grid[top_r][c] = SHELVE_CELL
+            shelve_tags_to_locations['D-%s-%d' % (top_aisle, column_number)] = [top_r, c]
+
+            navigation_grid[top_r + block_height - 1][c] = SHELVE_CELL
+            shelve_tags_to_locations['D-%s-%d' % (bottom_aisle, column_number + 1)] = [top_r + block_height - 1, c]
+
+    random_state = np.random.RandomState(seed)
+    shelve_tags = sorted(shelve_tags_to_locations)
+
+    books = []
+    for i in range(number_of_books):
+        _, aisle, column = shelve_tags[random_state.randint(len(shelve_tags))].split('-')
+        books.append({
+            'location': {'aisle': aisle, 'column': column, 'row': string.ascii_uppercase[random_state.randint(6)]},
+            'book': {'title': 'Synthetic Book %d' % i, 'author': 'Synthetic Author %d' % (i % 1000)},
+        })
+
+    return {
+        'version': utils.WAREHOUSE_JSON_FILE_FORMAT_VERSION,
+        'warehouseLayout': {
+            'numRows': num_rows,
+            'numCols': num_cols,
+            'verticalShelves': shelves_per_aisle,
+            'navigationGrid': navigation_grid,
+            'shelveTagsToLocations': shelve_tags_to_locations,
+        },
+        'books': books,
+    }
+
+
+def get_book_weights(number_of_books, popularity_skew, seed=0):
+    """ Zipf-like popularity: the k-th most popular book is picked with weight 1 / k ** popularity_skew. """
+
+    if popularity_skew == 0.0:
+        return None
+
+    weights = 1.0 / np.arange(1, number_of_books + 1) ** popularity_skew
+    np.random.RandomState(seed).shuffle(weights)
+
+    return weights / weights.sum()
+
+
+def run_scenario(scenario, number_of_pick_paths, source=(0, 0), seed=1):
+    """ Generates pick paths for the scenario, returning its end-to-end throughput and per-stage timings. """
+
+    instrumentation.enabled = True
+    instrumentation.reset()
+
+    with instrumentation.stage('warehouse_loading'):
+        if scenario['warehouse'] is None:
+            # Without the on-disk cache, so precompute and the TSP stages are measured on every run
+            gt_library_warehouse = utils.get_warehouse('warehouse.json', use_cache=False)
+        else:
+            gt_library_warehouse = utils.get_warehouse_from_dict(generate_synthetic_warehouse_data(
+                aisle_pairs=scenario['warehouse']['aislePairs'],
+                shelves_per_aisle=scenario['warehouse']['shelvesPerAisle'],
+                number_of_books=scenario['warehouse']['numberOfBooks'],
+            ))
+
+    with instrumentation.stage('precompute'):
+        gt_library_warehouse.precompute(depots=[source])
+
+    book_weights = get_book_weights(len(gt_library_warehouse.catalog), scenario['popularitySkew'])
+
+    start_time = time.time()
+    for path_id in range(1, number_of_pick_paths + 1):
+        with instrumentation.stage('pick_path'):
+            main.generate_pick_path_as_dict(
+                gt_library_warehouse,
+                scenario['booksPerPickPath'],
+                source,
+                random_state=main.get_pick_path_random_state(seed, path_id),
+                book_weights=book_weights,
+            )
+    elapsed_time = time.time() - start_time
+
+    summary = instrumentation.get_summary()
+    instrumentation.enabled = False
+
+    return {
+        'gridCells': gt_library_warehouse.num_rows * gt_library_warehouse.num_cols,
+        'numberOfPickPaths': number_of_pick_paths,
+        'pickPathsPerSecond': number_of_pick_paths / elapsed_time,
+        'stageMeanSeconds': {name: stage['mean'] for name, stage in summary['stages'].items()},
+        'counters': summary['counters'],
+    }
+
+
+def find_regressions(results, baselines, tolerance):
+    """
+    Lists every throughput or stage timing that got worse than its baseline by more than the tolerance, and every
+    baseline stage that no longer ran at all.
+    """
+
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        if name not in baselines:
+            continue
+
+        baseline = baselines[name]
+
+        if result['pickPathsPerSecond'] < baseline['pickPathsPerSecond'] / (1 + tolerance):
+            regressions.append('%s: %.2f pick paths per second, baseline is %.2f' % (
+                name, result['pickPathsPerSecond'], baseline['pickPathsPerSecond']))
+
+        for stage, baseline_mean_seconds in sorted(baseline['stageMeanSeconds'].items()):
+            mean_seconds = result['stageMeanSeconds'].get(stage)
+
+            # A stage that stopped running would otherwise hide any regression in it
+            if mean_seconds is None:
+                regressions.append('%s: stage %s did not run, baseline is %.6fs' % (
+                    name, stage, baseline_mean_seconds))
+
+            elif mean_seconds > baseline_mean_seconds * (1 + tolerance):
+                regressions.append('%s: stage %s takes %.6fs, baseline is %.6fs' % (
+                    name, stage, mean_seconds, baseline_mean_seconds))
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks pick path generation on synthetic warehouses.')
+    parser.add_argument('--scenarios', nargs='*', default=[scenario['name'] for scenario in BENCHMARK_SCENARIOS],
+                        help='Names of the scenarios to run (default: all).')
+    parser.add_argument('--pick-paths', type=int, default=20, help='Pick paths generated per scenario.')
+    parser.add_argument('--baselines', default='benchmark-baselines.json', help='Baseline results file.')
+    parser.add_argument('--save-baselines', action='store_true', help='Save the results as the new baselines.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Slowdown, as a fraction of the baseline, that counts as a regression.')
+    parser.add_argument('--write-layouts', metavar='DIRECTORY',
+                        help='Also write the synthetic warehouse layouts as JSON files to this directory.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # Keep per-path logging out of the timings
+    utils.quiet_per_path_logging()
+
+    args = parse_args()
+
+    scenarios = [scenario for scenario in BENCHMARK_SCENARIOS if scenario['name'] in args.scenarios]
+
+    if args.write_layouts:
+        for scenario in scenarios:
+            if scenario['warehouse'] is None:
+                continue
+
+            layout_file_path = os.path.join(args.write_layouts, 'warehouse-%s.json' % scenario['name'])
+            with open(layout_file_path, mode='w') as f:
+                json.dump(generate_synthetic_warehouse_data(
+                    aisle_pairs=scenario['warehouse']['aislePairs'],
+                    shelves_per_aisle=scenario['warehouse']['shelvesPerAisle'],
+                    number_of_books=scenario['warehouse']['numberOfBooks'],
+                ), f)
+
+    results = {}
+    for scenario in scenarios:
+        logger.info('Running scenario %s.', scenario['name'])
+        results[scenario['name']] = run_scenario(scenario, args.pick_paths)
+        logger.info('Scenario %s: %.2f pick paths per second.',
+                    scenario['name'], results[scenario['name']]['pickPathsPerSecond'])
+
+    if args.save_baselines:
+        with open(args.baselines, mode='w') as f:
+            json.dump({'version': BENCHMARK_BASELINES_FILE_FORMAT_VERSION, 'results': results}, f, indent=4,
+                      sort_keys=True)
+
+        logger.info('Saved baselines to %s.', args.baselines)
+
+    elif os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+        assert baselines['version'] == BENCHMARK_BASELINES_FILE_FORMAT_VERSION
+
+        regressions = find_regressions(results, baselines['results'], args.tolerance)
+        for regression in regressions:
+            logger.warning('Regression in %s', regression)
+
+        if regressions:
+            sys.exit(1)
+
+        logger.info('No regressions against %s.', args.baselines)
+
+    else:
+        print(json.dumps(results, indent=4, sort_keys=True))
@@ -6,3 +6,6 @@ OBSTACLE_CELL = 1
 SHELVE_CELL = 2
 
 SUBJECT_RADIUS = 0.5
+
+# Offsets of the cells reachable in one step, in the order their edges are added to the library graph
+NEIGHBOR_OFFSETS = ((-1, 0), (0, -1), (0, +1), (+1, 0))
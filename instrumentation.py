@@ -0,0 +1,109 @@
+import collections
+import time
+import numpy as np
+
+
+class Instrumentation(object):
+    """
+    Collects stage timings, counters and histograms of per-path values for the pick path pipeline. It is disabled by
+    default, in which case recording anything costs a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stage_durations = collections.defaultdict(list)
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(list)
+
+    def stage(self, name):
+        """ Returns a context manager that times the enclosed block as one run of the named stage. """
+
+        if not self.enabled:
+            return _NULL_STAGE
+
+        return _Stage(self, name)
+
+    def increment(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def observe(self, name, value):
+        """ Records one value, e.g. for one pick path, of the named histogram. """
+
+        if self.enabled:
+            self.histograms[name].append(value)
+
+    def get_snapshot(self):
+        """ Returns everything recorded so far as plain data, e.g. to send it from a worker process. """
+        return {
+            'stageDurations': dict(self.stage_durations),
+            'counters': dict(self.counters),
+            'histograms': dict(self.histograms),
+        }
+
+    def merge_snapshot(self, snapshot):
+        for name, durations in snapshot['stageDurations'].items():
+            self.stage_durations[name].extend(durations)
+
+        for name, count in snapshot['counters'].items():
+            self.counters[name] += count
+
+        for name, values in snapshot['histograms'].items():
+            self.histograms[name].extend(values)
+
+    def get_summary(self):
+        """ Summarizes everything recorded so far in a JSON-serializable dictionary. """
+        return {
+            'stages': {name: _summarize(durations) for name, durations in self.stage_durations.items()},
+            'counters': dict(self.counters),
+            'histograms': {name: _summarize(values) for name, values in self.histograms.items()},
+        }
+
+
+class _Stage(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.stage_durations[self.name].append(time.time() - self.start_time)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _summarize(values, number_of_bins=10):
+    values = np.asarray(values, dtype=float)
+
+    bin_counts, bin_edges = np.histogram(values, bins=number_of_bins)
+
+    return {
+        'count': len(values),
+        'total': float(values.sum()),
+        'mean': float(values.mean()),
+        'min': float(values.min()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+        'binCounts': bin_counts.tolist(),
+        'binEdges': bin_edges.tolist(),
+    }
+
+
+# Shared by the whole pipeline; enable it to start collecting
+instrumentation = Instrumentation()
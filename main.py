@@ -1,94 +1,379 @@
 from models import GTLibraryGridWarehouse
 import utils
-from tsp import held_karp as tsp_help_karp
+import storage
+import tsp_solvers
+from instrumentation import instrumentation
 import numpy as np
+import collections
 import json
 import logging
+import multiprocessing
 import os
 
 logger = logging.getLogger(os.path.basename(__file__))
 logger = utils.configure_logger(logger)
 
+# Kept here for code that imports it from main, the pick path file formats now live in storage
+PICK_PATH_FILE_FORMAT_VERSION = storage.PICK_PATH_FILE_FORMAT_VERSION
 
-PICK_PATH_FILE_FORMAT_VERSION = '1.2'
+# Number of pick paths generated together, so the TSPs of their orders can be solved in batches
+PICK_PATH_BATCH_SIZE = 32
 
 
-def generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source):  # type: (GTLibraryGridWarehouse, int, (int, int)) -> dict
+def generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source, random_state=np.random,
+                               max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                               tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET, book_weights=None,
+                               leg_router=utils.DEFAULT_LEG_ROUTER):
+    # type: (GTLibraryGridWarehouse, int, (int, int), np.random.RandomState, int, float, np.ndarray, str) -> dict
 
-    logger.debug('Choosing %d books at random.' % books_per_pick_path)
-    unordered_books = np.random.choice(
-        a=gt_library_warehouse.books,
-        size=books_per_pick_path,
-        replace=False,
-    )
+    order = sample_order(gt_library_warehouse, books_per_pick_path, random_state, book_weights)
+
+    return generate_pick_paths_as_dicts(
+        gt_library_warehouse, [order], source, max_exact_tsp_locations, tsp_time_budget, leg_router)[0]
+
+
+def sample_order(gt_library_warehouse, books_per_pick_path, random_state=np.random, book_weights=None):
+    # type: (GTLibraryGridWarehouse, int, np.random.RandomState, np.ndarray) -> (list, list)
+    """ Chooses the books of an order at random, returning them and their (r, c) locations. """
+
+    logger.debug('Choosing %d books at random.', books_per_pick_path)
+    with instrumentation.stage('sampling'):
+        # Books are equally popular unless they are given (normalized) weights
+        unordered_book_indices = random_state.choice(
+            a=len(gt_library_warehouse.catalog),
+            size=books_per_pick_path,
+            replace=False,
+            p=book_weights,
+        )
+
+    return get_order(gt_library_warehouse, unordered_book_indices)
+
+
+def get_order(gt_library_warehouse, book_indices):
+    # type: (GTLibraryGridWarehouse, list) -> (list, list)
+    """ Returns the books of an order, given their indices in the catalog, and their (r, c) locations. """
+
+    with instrumentation.stage('book_locations'):
+        unordered_books = gt_library_warehouse.catalog.get_books(book_indices)
+        unordered_books_locations = [
+            tuple(location) for location in gt_library_warehouse.catalog.get_locations(book_indices).tolist()]
+
+    return unordered_books, unordered_books_locations
+
+
+def generate_pick_paths_as_dicts(gt_library_warehouse, orders, source,
+                                 max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                                 tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET,
+                                 leg_router=utils.DEFAULT_LEG_ROUTER):
+    # type: (GTLibraryGridWarehouse, list, (int, int), int, float, str) -> list
+    """
+    Produces the pick paths of several orders, given as (books, book locations) pairs, all starting at the source. The
+    exact TSPs of orders on the same number of shelves are solved together. The tours are solved on the walking
+    distances of the routes leg_router finds (see utils.DEFAULT_LEG_ROUTER).
+    """
+
+    tsp_results = solve_order_tsps(
+        gt_library_warehouse, [locations for _, locations in orders], source, max_exact_tsp_locations, tsp_time_budget,
+        leg_router)
+
+    return [
+        _complete_pick_path_as_dict(gt_library_warehouse, books, locations, source, tsp_result, leg_router)
+        for (books, locations), tsp_result in zip(orders, tsp_results)
+    ]
+
+
+def solve_order_tsps(gt_library_warehouse, orders_books_locations, source,
+                     max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                     tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET, leg_router=utils.DEFAULT_LEG_ROUTER):
+    # type: (GTLibraryGridWarehouse, list, (int, int), int, float, str) -> list
+    """
+    Solves the TSP of every order, given as its list of book locations. Orders found in the TSP cache aren't solved
+    again, and the rest are solved in batches of orders on the same number of shelves with the batched Held-Karp
+    solver, or one by one with the heuristic solver when they are too large.
+    :return: The (tour, cost, lower bound) of every order, the tour being a tuple of locations starting and ending at
+             the source.
+    """
+
+    tsp_cache = gt_library_warehouse.get_tsp_cache(is_any_angle=leg_router == utils.ANY_ANGLE_LEG_ROUTER)
+    tsp_results = [tsp_cache.get(source, locations, max_exact_tsp_locations) for locations in orders_books_locations]
+
+    exact_problems_by_size = collections.defaultdict(list)
+
+    for i, books_locations in enumerate(orders_books_locations):
+        if tsp_results[i] is not None:
+            instrumentation.increment('tsp_cache_hits')
+            continue
 
-    unordered_books_locations = gt_library_warehouse.get_books_locations(unordered_books)
+        instrumentation.increment('tsp_cache_misses')
 
-    logger.debug('Getting sub-graph on chosen book locations and source for TSP.')
-    # If two books are on the same column, this method will consider them the same cell,
-    # This is why we'll need reintroduce_duplicate_column_locations later
-    G_subgraph = utils.get_subgraph_on_book_locations(gt_library_warehouse, unordered_books_locations, source)
+        logger.debug('Getting distance matrix on chosen book locations and source for TSP.')
+        # If two books are on the same column, this method will consider them the same location,
+        # This is why we'll need reintroduce_duplicate_column_locations later
+        with instrumentation.stage('distance_matrix'):
+            locations, distance_matrix = utils.get_distance_matrix_on_book_locations(
+                gt_library_warehouse, books_locations, source, leg_router)
 
-    logger.debug('Solving TSP for selected books.')
-    optimal_pick_path, optimal_cost = tsp_help_karp.solver(G_subgraph, source)
+        if len(locations) - 1 <= max_exact_tsp_locations:
+            exact_problems_by_size[len(locations)].append((i, locations, distance_matrix))
+            continue
+
+        logger.debug('Solving TSP for selected books heuristically.')
+        with instrumentation.stage('tsp'):
+            tour, cost, lower_bound = tsp_solvers.solve_tsp(
+                distance_matrix, max_exact_locations=max_exact_tsp_locations, time_budget=tsp_time_budget)
+
+        tsp_results[i] = tuple(locations[node] for node in tour), cost, lower_bound
+        tsp_cache.put(source, books_locations, *tsp_results[i])
+
+    for size, problems in sorted(exact_problems_by_size.items()):
+        logger.debug('Solving TSP for %d orders on %d locations.', len(problems), size - 1)
+        with instrumentation.stage('tsp'):
+            tours, costs = tsp_solvers.solve_held_karp_batch(np.array([matrix for _, _, matrix in problems]))
+
+        instrumentation.observe('tsp_batch_size', len(problems))
+
+        for (i, locations, _), tour, cost in zip(problems, tours, costs):
+            tsp_results[i] = tuple(locations[node] for node in tour), cost, cost
+            tsp_cache.put(source, orders_books_locations[i], *tsp_results[i])
+
+    return tsp_results
+
+
+def _complete_pick_path_as_dict(gt_library_warehouse, unordered_books, unordered_books_locations, source, tsp_result,
+                                leg_router=utils.DEFAULT_LEG_ROUTER):
+    """ Turns the TSP tour of an order into its cell-by-cell pick path, checks it and packages it as a dictionary. """
+
+    optimal_pick_path, optimal_cost, lower_bound = tsp_result
+
+    instrumentation.observe('locations_per_order', len(optimal_pick_path) - 2)
+    instrumentation.observe('tsp_cost', optimal_cost)
+
+    if optimal_cost > lower_bound:
+        instrumentation.increment('heuristic_tsp_tours')
+        logger.info('Heuristic tour on %d locations costs %s, at most %.1f%% above optimal.',
+                    len(optimal_pick_path) - 2, optimal_cost,
+                    100 * tsp_solvers.get_optimality_gap(optimal_cost, lower_bound))
 
     logger.debug('Patching up solution.')
-    ordered_books, ordered_locations = utils.reintroduce_duplicate_column_locations(
-        zip(unordered_books, unordered_books_locations), source, optimal_pick_path)
+    with instrumentation.stage('reintroduce_duplicates'):
+        ordered_books, ordered_locations = utils.reintroduce_duplicate_column_locations(
+            zip(unordered_books, unordered_books_locations), source, optimal_pick_path)
 
     # The optimal pick path has two more source locations (source, ..., source)
     assert len(unordered_books) == len(ordered_books) - 2 == len(ordered_locations) - 2
 
     logger.debug('Computing cell-by-cell pick path in library based on TSP solution.')
-    optimal_pick_path_in_library = utils.get_pick_path_in_library(gt_library_warehouse, ordered_locations, source)
+    optimal_pick_path_in_library = utils.get_pick_path_in_library(
+        gt_library_warehouse, ordered_locations, source, leg_router)
 
     logger.debug('Verifying solution has right format and cost.')
-    utils.assert_library_pick_path_is_proper(optimal_pick_path_in_library, ordered_locations, source)
-    utils.assert_library_pick_path_has_cost(optimal_pick_path_in_library, optimal_cost, len(ordered_books[1:-1]))
+    with instrumentation.stage('validation'):
+        utils.assert_library_pick_path_is_proper(optimal_pick_path_in_library, ordered_locations, source)
+        utils.assert_library_pick_path_has_cost(optimal_pick_path_in_library, optimal_cost, len(ordered_books[1:-1]))
 
     logger.debug('Packaging solution in dictionary.')
-    return utils.get_pick_path_as_dict(
-        unordered_books, unordered_books_locations, ordered_books, ordered_locations, optimal_pick_path_in_library)
+    with instrumentation.stage('packaging'):
+        return utils.get_pick_path_as_dict(
+            unordered_books, unordered_books_locations, ordered_books, ordered_locations, optimal_pick_path_in_library)
 
 
-def get_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source):
-    # East-side of library is top of array
-    gt_library_warehouse = utils.get_warehouse('warehouse.json')
+def get_pick_path_random_state(seed, path_id):
+    """ Returns the random state of the given path, derived from the global seed so it doesn't depend on order. """
+    return np.random.RandomState([seed, path_id])
+
+
+# The settings shared by every pick path of a run
+PickPathSettings = collections.namedtuple('PickPathSettings', [
+    'books_per_pick_path', 'source', 'seed', 'max_exact_tsp_locations', 'tsp_time_budget', 'leg_router'])
+
+PickPathTask = collections.namedtuple('PickPathTask', ['path_id', 'path_type'])
 
-    pick_paths = []
 
+def get_pick_path_tasks(number_of_training_pick_paths, number_of_testing_pick_paths, skip_path_ids=()):
     for i in range(number_of_training_pick_paths + number_of_testing_pick_paths):
-        logger.info("Processing path #%s" % (i + 1,))
+        if i + 1 in skip_path_ids:
+            continue
 
-        pick_path_as_dict = generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source)
+        path_type = 'training' if i < number_of_training_pick_paths else 'testing'
+        yield PickPathTask(i + 1, path_type)
+
+
+def generate_pick_paths(gt_library_warehouse, tasks, settings):
+    # type: (GTLibraryGridWarehouse, list, PickPathSettings) -> list
+    """
+    Generates the pick paths of several tasks together, so that the TSPs of same-size orders are solved in batches.
+    Every pick path is the same as if its task was generated on its own.
+    """
+
+    with instrumentation.stage('pick_path_batch'):
+        orders = []
+        for task in tasks:
+            logger.info("Processing path #%s", task.path_id)
+            orders.append(sample_order(
+                gt_library_warehouse, settings.books_per_pick_path,
+                random_state=get_pick_path_random_state(settings.seed, task.path_id)))
+
+        pick_paths_as_dicts = generate_pick_paths_as_dicts(
+            gt_library_warehouse, orders, settings.source, settings.max_exact_tsp_locations,
+            settings.tsp_time_budget, settings.leg_router)
+
+    pick_paths = []
+    for task, pick_path_as_dict in zip(tasks, pick_paths_as_dicts):
+        logger.info("Completed path #%s", task.path_id)
 
         pick_paths.append({
-            'pathId': i + 1,
-            'pathType': 'training' if i < number_of_training_pick_paths else 'testing',
+            'pathId': task.path_id,
+            'pathType': task.path_type,
             'pickPathInformation': pick_path_as_dict
         })
 
-        logger.info("Completed path #%s" % (i + 1,))
-
     return pick_paths
 
 
-if __name__ == '__main__':
-    np.random.seed(1)
+def get_task_batches(tasks, batch_size):
+    """ Splits the tasks into lists of up to batch_size consecutive tasks. """
+
+    batch = []
+    for task in tasks:
+        batch.append(task)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+# The warehouse of each worker process, loaded once by _initialize_worker
+worker_gt_library_warehouse = None
+
+
+def _initialize_worker(warehouse_file_path, source, is_instrumented, persist_tsp_tours):
+    global worker_gt_library_warehouse
+    worker_gt_library_warehouse = utils.get_warehouse(warehouse_file_path, persist_tsp_tours=persist_tsp_tours)
+    worker_gt_library_warehouse.precompute(depots=[source])
+
+    instrumentation.enabled = is_instrumented
+
+
+def _generate_pick_paths_in_worker(arguments):
+    """ Generates pick paths, returning them along with what the worker's instrumentation recorded since the last ones. """
+
+    tasks, settings = arguments
+    pick_paths = generate_pick_paths(worker_gt_library_warehouse, tasks, settings)
+
+    instrumentation_snapshot = instrumentation.get_snapshot()
+    instrumentation.reset()
+
+    return pick_paths, instrumentation_snapshot
+
+
+def iter_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source,
+                    seed=1, number_of_workers=1, warehouse_file_path='warehouse.json', skip_path_ids=(),
+                    max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                    tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET, leg_router=utils.DEFAULT_LEG_ROUTER,
+                    persist_tsp_tours=False):
+    """
+    Yields the pick paths in pathId order, leaving out the paths in skip_path_ids. They are generated in batches of up
+    to PICK_PATH_BATCH_SIZE, whose same-size TSPs are solved together. With more than one worker, the batches are
+    generated in a pool of processes that each load the warehouse once. Every path gets its own
+    seed, so the output doesn't depend on the number of workers or on which paths are skipped. Orders on more than
+    max_exact_tsp_locations shelves are solved heuristically within tsp_time_budget seconds. Legs are routed, and
+    tours solved on the walking distances of, the given leg_router (see utils.DEFAULT_LEG_ROUTER). With
+    persist_tsp_tours, exact tours are persisted in the warehouse cache and reused by later runs.
+    """
+
+    tasks = list(get_pick_path_tasks(number_of_training_pick_paths, number_of_testing_pick_paths, skip_path_ids))
+    settings = PickPathSettings(
+        books_per_pick_path, source, seed, max_exact_tsp_locations, tsp_time_budget, leg_router)
+
+    if number_of_workers == 1:
+        # East-side of library is top of array
+        gt_library_warehouse = utils.get_warehouse(warehouse_file_path, persist_tsp_tours=persist_tsp_tours)
+        gt_library_warehouse.precompute(depots=[source])
 
-    pick_paths = get_pick_paths(
-        number_of_training_pick_paths=20,
-        number_of_testing_pick_paths=20,
-        books_per_pick_path=10,
-        source=(0, 0),
+        for task_batch in get_task_batches(tasks, PICK_PATH_BATCH_SIZE):
+            for pick_path in generate_pick_paths(gt_library_warehouse, task_batch, settings):
+                yield pick_path
+
+        return
+
+    # Saves the derived structures to the warehouse cache once, so every worker only has to memory-map them
+    utils.get_warehouse(warehouse_file_path).precompute(depots=[source])
+
+    # Smaller batches when there are few tasks, so that every worker gets some
+    batch_size = max(1, min(PICK_PATH_BATCH_SIZE, len(tasks) // (4 * number_of_workers)))
+
+    pool = multiprocessing.Pool(
+        processes=number_of_workers,
+        initializer=_initialize_worker,
+        initargs=(warehouse_file_path, source, instrumentation.enabled, persist_tsp_tours),
     )
 
-    with open('pick-paths.json', mode='w+') as f:
-        json.dump(
-            obj={
-                'version': PICK_PATH_FILE_FORMAT_VERSION,
-                'pickPaths': pick_paths
-            },
-            fp=f,
-            indent=4,
-        )
+    try:
+        for pick_paths, instrumentation_snapshot in pool.imap(
+                _generate_pick_paths_in_worker,
+                ((task_batch, settings) for task_batch in get_task_batches(tasks, batch_size))):
+            instrumentation.merge_snapshot(instrumentation_snapshot)
+
+            for pick_path in pick_paths:
+                yield pick_path
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source,
+                   seed=1, number_of_workers=1, max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                   tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET, leg_router=utils.DEFAULT_LEG_ROUTER,
+                   persist_tsp_tours=False):
+    return list(iter_pick_paths(
+        number_of_training_pick_paths,
+        number_of_testing_pick_paths,
+        books_per_pick_path,
+        source,
+        seed=seed,
+        number_of_workers=number_of_workers,
+        max_exact_tsp_locations=max_exact_tsp_locations,
+        tsp_time_budget=tsp_time_budget,
+        leg_router=leg_router,
+        persist_tsp_tours=persist_tsp_tours,
+    ))
+
+
+if __name__ == '__main__':
+    # Pick up where a previous, interrupted run left off in pick-paths.jsonl instead of starting over
+    resume = False
+
+    # Time every stage of the pipeline and write a summary to pick-paths-stats.json
+    instrumentation.enabled = True
+
+    # Also write the pick paths to pick-paths.bin, in the compact binary format of storage.PickPathBinaryWriter
+    write_binary = False
+
+    # Keep the exact TSP tours in .warehouse-cache/tsp-cache.sqlite, so later runs on the same layout reuse them
+    persist_tsp_tours = False
+
+    with storage.PickPathJsonLinesWriter('pick-paths.jsonl', resume=resume) as writer:
+        for pick_path in iter_pick_paths(
+                number_of_training_pick_paths=20,
+                number_of_testing_pick_paths=20,
+                books_per_pick_path=10,
+                source=(0, 0),
+                seed=1,
+                number_of_workers=multiprocessing.cpu_count(),
+                skip_path_ids=writer.written_path_ids,
+                persist_tsp_tours=persist_tsp_tours):
+            writer.write(pick_path)
+
+    storage.export_json_lines_to_json('pick-paths.jsonl', 'pick-paths.json')
+
+    if write_binary:
+        storage.export_json_lines_to_binary('pick-paths.jsonl', 'pick-paths.bin')
+
+    if instrumentation.enabled:
+        with open('pick-paths-stats.json', mode='w') as f:
+            json.dump(instrumentation.get_summary(), f, indent=4, sort_keys=True)
+
+        logger.info('Wrote pipeline statistics to pick-paths-stats.json.')
@@ -1,8 +1,14 @@
 from constants import SHELVE_CELL, OBSTACLE_CELL, NAVIGABLE_CELL
+import collections
 import copy
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 import numpy as np
-from constants import SUBJECT_RADIUS
-import itertools
+from constants import SUBJECT_RADIUS, NEIGHBOR_OFFSETS
+from instrumentation import instrumentation
 
 
 class Book(object):
@@ -13,6 +19,13 @@ class Book(object):
         self.column = column
         self.row = row
 
+    @classmethod
+    def from_dict(cls, book_dict):
+        """ Returns the book described by a dictionary made by as_dict. """
+
+        _, aisle, column, row = book_dict['tag'].split('-')
+        return cls(book_dict['title'], book_dict['author'], aisle, column, row)
+
     @property
     def tag(self):
         return "D-%s-%s-%s" % (self.aisle, self.column, self.row)
@@ -24,12 +37,20 @@ class Book(object):
     def __str__(self):
         return "%s: %s by %s" % (self.tag, self.title, self.author)
 
+    def _key(self):
+        return self.aisle, self.column, self.row, self.title, self.author
+
     def __hash__(self):
-        return hash(str(self))
+        return hash(self._key())
 
     def __eq__(self, other):
+        if isinstance(other, Book):
+            return self._key() == other._key()
         return str(self) == str(other)
 
+    def __ne__(self, other):
+        return not self == other
+
     def as_dict(self):
         return {
             "title": self.title,
@@ -38,36 +59,158 @@ class Book(object):
         }
 
 
+class BookCatalog(object):
+    """
+    Columnar store of the books in a warehouse. Strings are interned into tables and each book is a row of integer
+    codes into them, along with the (r, c) location of its shelve. Book instances are only created when asked for.
+    """
+
+    def __init__(self, book_dicts, shelve_tags_to_locations):
+
+        self.titles, self.authors, self.aisles, self.columns, self.rows = [], [], [], [], []
+
+        string_tables = (self.titles, self.authors, self.aisles, self.columns, self.rows)
+        string_codes = tuple({} for _ in string_tables)
+
+        codes = []
+        for book_dict in book_dicts:
+            strings = (
+                book_dict['book']['title'],
+                book_dict['book']['author'],
+                book_dict['location']['aisle'],
+                book_dict['location']['column'],
+                book_dict['location']['row'],
+            )
+
+            book_codes = []
+            for string, string_table, codes_of_strings in zip(strings, string_tables, string_codes):
+                if string not in codes_of_strings:
+                    codes_of_strings[string] = len(string_table)
+                    string_table.append(string)
+                book_codes.append(codes_of_strings[string])
+
+            codes.append(book_codes)
+
+        codes = np.array(codes, dtype=np.int32).reshape(-1, len(string_tables))
+        self.title_codes, self.author_codes, self.aisle_codes, self.column_codes, self.row_codes = codes.T.copy()
+
+        # Every distinct (aisle, column) pair is a shelve, so each of them is only looked up once
+        shelves, shelve_codes = np.unique(
+            self.aisle_codes.astype(np.int64) * len(self.columns) + self.column_codes, return_inverse=True)
+
+        shelve_locations = np.zeros((len(shelves), 2), dtype=np.int32)
+        unknown_shelve_tags = []
+        for i, shelve in enumerate(shelves.tolist()):
+            aisle, column = self.aisles[shelve // len(self.columns)], self.columns[shelve % len(self.columns)]
+            shelve_tag = "D-%s-%s" % (aisle, column)
+
+            if shelve_tag in shelve_tags_to_locations:
+                shelve_locations[i] = shelve_tags_to_locations[shelve_tag]
+            else:
+                unknown_shelve_tags.append(shelve_tag)
+
+        # Report books on unknown shelves when loading, rather than when they're first picked
+        if unknown_shelve_tags:
+            raise ValueError("Books are on unknown shelves %s" % ', '.join(sorted(unknown_shelve_tags)))
+
+        self.locations = shelve_locations[shelve_codes.reshape(-1)]
+
+        self._indices_by_tag = None
+
+    def __len__(self):
+        return len(self.title_codes)
+
+    def get_book(self, index):
+        return Book(
+            title=self.titles[self.title_codes[index]],
+            author=self.authors[self.author_codes[index]],
+            aisle=self.aisles[self.aisle_codes[index]],
+            column=self.columns[self.column_codes[index]],
+            row=self.rows[self.row_codes[index]],
+        )
+
+    def get_books(self, indices):
+        return [self.get_book(index) for index in indices]
+
+    def get_book_indices(self, tags):
+        """ Returns the indices of the books with the given tags, e.g. D-A-100-B, the first one if a tag is shared. """
+
+        # Built aside and published at once, as service request threads may look tags up concurrently
+        if self._indices_by_tag is None:
+            indices_by_tag = {}
+            for index in range(len(self) - 1, -1, -1):
+                indices_by_tag["D-%s-%s-%s" % (
+                    self.aisles[self.aisle_codes[index]],
+                    self.columns[self.column_codes[index]],
+                    self.rows[self.row_codes[index]],
+                )] = index
+
+            self._indices_by_tag = indices_by_tag
+
+        unknown_tags = [tag for tag in tags if tag not in self._indices_by_tag]
+        if unknown_tags:
+            raise ValueError("Couldn't find books with tags %s" % ', '.join(unknown_tags))
+
+        return [self._indices_by_tag[tag] for tag in tags]
+
+    def get_locations(self, indices):
+        """ Returns the (k, 2) array of the (r, c) locations of the books with the given indices. """
+        return self.locations[indices]
+
+
 class GTLibraryGridWarehouse(object):
     NUMBER_OF_SHELVES = 6 * 8
 
-    def __init__(self, dimensions, navigation_grid, shelve_tags_to_locations, book_dicts):
+    # Number of is_clear_shot results kept around, shared by every pick path generated on this warehouse
+    CLEAR_SHOT_CACHE_SIZE = 2 ** 16
+
+    # Slack used when deciding which cells could be within the subject's radius, to absorb floating point error
+    CLEAR_SHOT_TOLERANCE = 1e-9
+
+    # Bump when the files written by save_precomputed change, so stale caches are ignored
+    PRECOMPUTED_CACHE_FORMAT_VERSION = '2'
+
+    # SQLite file, in the cache directory, where the TSP tours solved on every layout are persisted
+    TSP_CACHE_FILE_NAME = 'tsp-cache.sqlite'
+
+    def __init__(self, dimensions, navigation_grid, shelve_tags_to_locations, book_dicts,
+                 number_of_shelves=NUMBER_OF_SHELVES, cache_directory=None, persist_tsp_tours=False):
 
         self.dimensions = dimensions
         num_rows, num_cols = dimensions
 
         self.navigation_grid = copy.deepcopy(navigation_grid)
+        self.navigation_grid_array = np.array(navigation_grid, dtype=np.int8)
         assert len(navigation_grid) == num_rows
         assert len(navigation_grid[0]) == num_cols
 
-        for row in navigation_grid:
-            for cell in row:
-                assert cell == NAVIGABLE_CELL \
-                       or cell == OBSTACLE_CELL \
-                       or cell == SHELVE_CELL
+        assert np.isin(self.navigation_grid_array, (NAVIGABLE_CELL, OBSTACLE_CELL, SHELVE_CELL)).all()
 
-        assert len(shelve_tags_to_locations) == self.NUMBER_OF_SHELVES
-        self.locations_to_shelve_tags = {tuple(location): tag for tag, location in shelve_tags_to_locations.iteritems()}
+        assert len(shelve_tags_to_locations) == number_of_shelves
+        self.shelve_tags_to_locations = {tag: tuple(location) for tag, location in shelve_tags_to_locations.iteritems()}
+        self.locations_to_shelve_tags = {location: tag for tag, location in self.shelve_tags_to_locations.iteritems()}
 
-        self.books = []
-        for book_dict in book_dicts:
-            self.books.append(Book(
-                title=book_dict['book']['title'],
-                author=book_dict['book']['author'],
-                aisle=book_dict['location']['aisle'],
-                column=book_dict['location']['column'],
-                row=book_dict['location']['row'],
-            ))
+        for shelve_location in self.locations_to_shelve_tags:
+            assert self.get_cell(*shelve_location) is SHELVE_CELL, \
+                "Shelve %s isn't on a shelve cell." % (shelve_location,)
+
+        self.catalog = BookCatalog(book_dicts, self.shelve_tags_to_locations)
+
+        # Where precompute persists the derived structures, in a subdirectory named after the layout hash
+        self.cache_directory = cache_directory
+
+        # Whether the exact TSP tours solved on this warehouse are persisted in the cache directory too
+        self.persist_tsp_tours = persist_tsp_tours
+
+        self._adjacency = None
+        self._neighbor_lists = None
+        self._grid_router = None
+        self._aisle_graph = None
+        self._any_angle_router = None
+        self._distance_oracle = None
+        self._clearance_map = None
+        self._clear_shot_cache = None
+        self._tsp_caches = {}
 
     @property
     def num_rows(self):
@@ -77,31 +220,299 @@ class GTLibraryGridWarehouse(object):
     def num_cols(self):
         return self.dimensions[1]
 
-    def get_book_location(self, target_book):
-        """ Given a Book instance, this method finds the (r, c) location of the book in this warehouse. """
+    def get_adjacency(self):
+        """ Returns the (memoized) CSR adjacency structure (indptr, indices) of the navigable cells. """
+
+        import utils
+
+        if self._adjacency is None:
+            self._adjacency = utils.get_grid_adjacency(self.navigation_grid_array)
+
+        return self._adjacency
+
+    def get_neighbor_lists(self):
+        """
+        Returns the (memoized) list of the navigable neighbors of every flattened cell, for searches that visit cells
+        one at a time. Unlike the CSR adjacency structure, it is updated in place when cells are flipped.
+        """
+
+        if self._neighbor_lists is None:
+            indptr, indices = self.get_adjacency()
+            indptr, indices = np.asarray(indptr).tolist(), np.asarray(indices).tolist()
+            self._neighbor_lists = [indices[indptr[i]:indptr[i + 1]] for i in range(len(indptr) - 1)]
+
+        return self._neighbor_lists
+
+    def get_grid_router(self):
+        """ Returns the (memoized) A* router over the navigable cells, whose search buffers every route reuses. """
+
+        import routing
+
+        if self._grid_router is None:
+            self._grid_router = routing.GridRouter(self)
+
+        return self._grid_router
+
+    def get_aisle_graph(self, depots=()):
+        """ Returns the (memoized) aisle-level graph, rebuilt when a depot isn't one of its nodes yet. """
+
+        import routing
+
+        if self._aisle_graph is None or any(depot not in self._aisle_graph for depot in depots):
+            self._aisle_graph = routing.AisleGraph(self, depots=depots)
+
+        return self._aisle_graph
+
+    def get_any_angle_router(self):
+        """ Returns the (memoized) Theta* router, whose searches are cached across pick paths. """
+
+        import routing
+
+        if self._any_angle_router is None:
+            self._any_angle_router = routing.AnyAngleRouter(self)
+
+        return self._any_angle_router
+
+    def get_distance_oracle(self, depots=()):
+        """ Returns the access-cell distance oracle of this warehouse, built once and extended with any new depots. """
+
+        import oracle
+
+        if self._distance_oracle is None:
+            self._distance_oracle = oracle.AccessCellDistanceOracle(self, depots=depots)
+        else:
+            self._distance_oracle.add_sources(depots)
+
+        return self._distance_oracle
+
+    def precompute(self, depots=()):
+        """
+        Builds every memoized structure up front, e.g. before this warehouse is used by a worker process. With a cache
+        directory, the structures are memory-mapped from there when this layout was precomputed before, and saved
+        there otherwise (or when new depots had to be added).
+        """
+
+        precomputed_directory = self.get_precomputed_directory()
+
+        if precomputed_directory is not None and os.path.isdir(precomputed_directory):
+            self.load_precomputed(precomputed_directory)
+
+        number_of_sources = len(self._distance_oracle.sources) if self._distance_oracle is not None else 0
+
+        self.get_adjacency()
+        self.get_grid_router()
+        self.get_distance_oracle(depots=depots)
+        self.get_aisle_graph(depots=depots)
+        self.get_clearance_map()
+
+        if precomputed_directory is not None and len(self._distance_oracle.sources) != number_of_sources:
+            self.save_precomputed(precomputed_directory)
+
+    def get_layout_hash(self):
+        """ Returns a content hash of the navigation grid and shelve locations, which the derived structures depend on. """
+
+        layout_hash = hashlib.sha1(self.PRECOMPUTED_CACHE_FORMAT_VERSION.encode('utf-8'))
+        layout_hash.update(json.dumps(self.navigation_grid_array.shape).encode('utf-8'))
+        layout_hash.update(np.ascontiguousarray(self.navigation_grid_array).tobytes())
+        layout_hash.update(json.dumps(sorted(self.shelve_tags_to_locations.items())).encode('utf-8'))
+
+        return layout_hash.hexdigest()
 
-        for r in range(self.num_rows):
-            for c in range(self.num_cols):
+    def get_precomputed_directory(self):
+        if self.cache_directory is None:
+            return None
 
-                # Only examine shelve cells
-                cell = self.get_cell(r, c)
-                if cell is not SHELVE_CELL:
-                    continue
+        return os.path.join(self.cache_directory, self.get_layout_hash())
 
-                shelve_tag_at_location = self.get_shelve_tag(r, c)
+    def save_precomputed(self, directory):
+        """
+        Saves the grid array, the adjacency structure, the distance oracle and the clearance map as .npy files in the
+        given directory. The files are written to a temporary directory first and moved into place, so concurrent
+        processes never see a partial cache.
+        """
 
-                if shelve_tag_at_location == target_book.shelve_tag:
-                    return (r, c)
+        parent_directory = os.path.dirname(os.path.abspath(directory))
+        if not os.path.isdir(parent_directory):
+            os.makedirs(parent_directory)
 
-        raise ValueError("Couldn't find book with tag %s" % target_book.tag)
+        temporary_directory = tempfile.mkdtemp(dir=parent_directory)
+        try:
+            indptr, indices = self.get_adjacency()
 
-    def get_books_locations(self, target_books):
-        book_locations = []
+            np.save(os.path.join(temporary_directory, 'grid.npy'), self.navigation_grid_array)
+            np.save(os.path.join(temporary_directory, 'adjacency_indptr.npy'), indptr)
+            np.save(os.path.join(temporary_directory, 'adjacency_indices.npy'), indices)
+            np.save(os.path.join(temporary_directory, 'clearance_map.npy'), self.get_clearance_map())
+            self.get_distance_oracle().save(temporary_directory)
 
-        for target_book in target_books:
-            book_locations.append(self.get_book_location(target_book))
+            if os.path.isdir(directory):
+                shutil.rmtree(directory, ignore_errors=True)
 
-        return book_locations
+            try:
+                os.rename(temporary_directory, directory)
+            except OSError:
+                # Another process saved the same layout first
+                pass
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    def load_precomputed(self, directory):
+        """ Memory-maps the structures saved by save_precomputed, read-only and without validating them again. """
+
+        import oracle
+
+        def load(file_name):
+            return np.load(os.path.join(directory, file_name), mmap_mode='r')
+
+        self.navigation_grid_array = load('grid.npy')
+        self._adjacency = load('adjacency_indptr.npy'), load('adjacency_indices.npy')
+        self._clearance_map = load('clearance_map.npy')
+        self._distance_oracle = oracle.AccessCellDistanceOracle.load(self, directory)
+
+    def block_cells(self, cells):
+        """ Turns the given navigable cells into obstacles, e.g. for a cart left in an aisle. See set_cells. """
+        self.set_cells(cells, OBSTACLE_CELL)
+
+    def unblock_cells(self, cells):
+        """ Turns the given obstacle cells back into navigable cells. See set_cells. """
+        self.set_cells(cells, NAVIGABLE_CELL)
+
+    def set_cells(self, cells, cell_type):
+        """
+        Flips the given cells between NAVIGABLE_CELL and OBSTACLE_CELL, repairing the structures derived from the
+        layout that have been built instead of rebuilding them: the neighbor lists around the cells, the distance
+        oracle rows whose shortest paths change, the clearance map near the cells and the cached is_clear_shot results
+        whose segments pass close to them. The CSR adjacency structure, the aisle graph and the any-angle router are
+        rebuilt when next asked for, and cached TSP tours are dropped. Shelve cells and the sources of the distance
+        oracle (shelve access cells and depots) can't be flipped.
+        """
+
+        assert cell_type is NAVIGABLE_CELL or cell_type is OBSTACLE_CELL
+
+        cells = [tuple(cell) for cell in cells]
+        for r, c in cells:
+            assert 0 <= r < self.num_rows and 0 <= c < self.num_cols
+
+            if self.get_cell(r, c) is SHELVE_CELL:
+                raise ValueError("Cell %s is a shelve and can't be flipped" % ((r, c),))
+
+            if self._distance_oracle is not None and (r, c) in self._distance_oracle.source_indices:
+                raise ValueError("Cell %s is a shelve access cell or a depot and can't be flipped" % ((r, c),))
+
+        # Each cell is flipped once, however many times it is given
+        cells = [cell for cell in collections.OrderedDict.fromkeys(cells) if self.get_cell(*cell) is not cell_type]
+        if not cells:
+            return
+
+        with instrumentation.stage('layout_update'):
+            # The neighbor lists are repaired in place, so build them from the layout before the flips
+            neighbor_lists = self.get_neighbor_lists()
+
+            # Arrays memory-mapped from the warehouse cache are read-only
+            if not self.navigation_grid_array.flags.writeable:
+                self.navigation_grid_array = np.array(self.navigation_grid_array)
+
+            for cell in cells:
+                r, c = cell
+                index = r * self.num_cols + c
+
+                self.navigation_grid[r][c] = cell_type
+                self.navigation_grid_array[r, c] = cell_type
+
+                neighbor_indices = [
+                    (r + offset_r) * self.num_cols + c + offset_c for offset_r, offset_c in NEIGHBOR_OFFSETS
+                    if 0 <= r + offset_r < self.num_rows and 0 <= c + offset_c < self.num_cols
+                    and self.get_cell(r + offset_r, c + offset_c) is NAVIGABLE_CELL
+                ]
+
+                if cell_type is OBSTACLE_CELL:
+                    neighbor_lists[index] = []
+                    for neighbor_index in neighbor_indices:
+                        neighbor_lists[neighbor_index].remove(index)
+                else:
+                    # Neighbors are listed in increasing index order, like NEIGHBOR_OFFSETS
+                    neighbor_lists[index] = neighbor_indices
+                    for neighbor_index in neighbor_indices:
+                        neighbor_lists[neighbor_index] = sorted(neighbor_lists[neighbor_index] + [index])
+
+                if self._clearance_map is not None:
+                    self._update_clearance_map(cell, cell_type)
+
+            if self._distance_oracle is not None:
+                # Blocked cells are repaired together, as their subtrees often overlap
+                if cell_type is OBSTACLE_CELL:
+                    self._distance_oracle.block_cells(cells)
+                else:
+                    for cell in cells:
+                        self._distance_oracle.unblock_cell(cell)
+
+            if self._clear_shot_cache is not None:
+                self._invalidate_clear_shots(cells)
+
+            self._adjacency = None
+            self._aisle_graph = None
+            self._any_angle_router = None
+
+            # Walking distances changed, so cached tours may no longer be optimal
+            for tsp_cache in self._tsp_caches.values():
+                tsp_cache.close()
+            self._tsp_caches = {}
+
+    def _update_clearance_map(self, cell, cell_type):
+        import utils
+
+        if not self._clearance_map.flags.writeable:
+            self._clearance_map = np.array(self._clearance_map)
+
+        r, c = cell
+        rows, cols = np.indices(self._clearance_map.shape)
+        distances_to_cell = np.sqrt((rows - r) ** 2 + (cols - c) ** 2)
+
+        if cell_type is OBSTACLE_CELL:
+            np.minimum(self._clearance_map, distances_to_cell, out=self._clearance_map)
+            return
+
+        # Only the cells that had this one as their closest obstacle need their clearance again
+        affected_rows, affected_cols = np.nonzero(
+            np.abs(self._clearance_map - distances_to_cell) <= self.CLEAR_SHOT_TOLERANCE)
+
+        blocked_rows, blocked_cols = np.nonzero(self.navigation_grid_array != NAVIGABLE_CELL)
+        if len(blocked_rows) == 0:
+            self._clearance_map[:] = np.inf
+            return
+
+        # Their new closest obstacle is at most this far, so it lies within this window around them
+        reach = int(np.ceil(self._clearance_map[affected_rows, affected_cols].max()
+                            + np.sqrt((blocked_rows - r) ** 2 + (blocked_cols - c) ** 2).min()))
+
+        first_row, last_row = max(0, affected_rows.min() - reach), min(self.num_rows, affected_rows.max() + reach + 1)
+        first_col, last_col = max(0, affected_cols.min() - reach), min(self.num_cols, affected_cols.max() + reach + 1)
+
+        window_clearance_map = utils.get_clearance_map(
+            self.navigation_grid_array[first_row:last_row, first_col:last_col])
+
+        self._clearance_map[affected_rows, affected_cols] = \
+            window_clearance_map[affected_rows - first_row, affected_cols - first_col]
+
+    def _invalidate_clear_shots(self, cells):
+        """ Drops the cached is_clear_shot results of segments that pass within their radius of any of the cells. """
+
+        import utils
+
+        keys = self._clear_shot_cache.keys()
+        if not keys:
+            return
+
+        lines = np.array([(location_a, location_b) for location_a, location_b, _ in keys], dtype=float)
+        radii = np.array([radius for _, _, radius in keys])
+
+        cell_distances = utils.minimumDistances(lines, np.array(cells, dtype=float))
+        is_affected = np.any(cell_distances <= (radii + self.CLEAR_SHOT_TOLERANCE)[:, np.newaxis], axis=1)
+
+        for i in np.flatnonzero(is_affected):
+            self._clear_shot_cache.pop(keys[i])
+
+        instrumentation.increment('clear_shot_cache_invalidations', int(is_affected.sum()))
 
     def get_cell(self, row, col):
         return self.navigation_grid[row][col]
@@ -109,7 +520,53 @@ class GTLibraryGridWarehouse(object):
     def get_shelve_tag(self, row, col):
         return self.locations_to_shelve_tags.get((row, col), None)
 
+    def get_clearance_map(self):
+        """ Returns the (memoized) distance from every cell to the closest non-navigable cell. """
+
+        import utils
+
+        if self._clearance_map is None:
+            self._clearance_map = utils.get_clearance_map(self.navigation_grid_array)
+
+        return self._clearance_map
+
+    def get_tsp_cache(self, is_any_angle=False):
+        """
+        Returns the cache of TSP tours solved on this warehouse, on cell-by-cell or any-angle walking distances. With a
+        cache directory and persist_tsp_tours set, the exact tours are also persisted there in a SQLite file, so
+        replayed workloads don't have to solve them again.
+        """
+
+        import tsp_solvers
+
+        if is_any_angle not in self._tsp_caches:
+            file_path = None
+            if self.cache_directory is not None and self.persist_tsp_tours:
+                if not os.path.isdir(self.cache_directory):
+                    os.makedirs(self.cache_directory)
+
+                file_path = os.path.join(self.cache_directory, self.TSP_CACHE_FILE_NAME)
+
+            namespace = self.get_layout_hash() + ('-any-angle' if is_any_angle else '')
+            self._tsp_caches[is_any_angle] = tsp_solvers.TSPCache(file_path=file_path, namespace=namespace)
+
+        return self._tsp_caches[is_any_angle]
+
+    def get_clear_shot_cache(self):
+        """ Returns the LRU cache of is_clear_shot results, keyed by (location_a, location_b, radius). """
+
+        import utils
+
+        if self._clear_shot_cache is None:
+            self._clear_shot_cache = utils.LRUCache(self.CLEAR_SHOT_CACHE_SIZE)
+
+        return self._clear_shot_cache
+
     def is_clear_shot(self, location_a, location_b, radius=SUBJECT_RADIUS):
+        """
+        Determines if a subject of the given radius can walk in a straight line between the two cells, i.e. if no
+        non-navigable cell is within the radius of the segment between them. Results are memoized.
+        """
 
         assert radius > 0.0
 
@@ -119,23 +576,77 @@ class GTLibraryGridWarehouse(object):
         if location_a == location_b:
             return True
 
+        instrumentation.increment('clear_shot_calls')
+
+        clear_shot_cache = self.get_clear_shot_cache()
+        key = (tuple(location_a), tuple(location_b), radius)
+
+        is_clear = clear_shot_cache.get(key)
+        if is_clear is not None:
+            instrumentation.increment('clear_shot_cache_hits')
+        else:
+            is_clear = self._is_clear_shot(location_a, location_b, radius)
+            clear_shot_cache.put(key, is_clear)
+
+        return is_clear
+
+    def _is_clear_shot(self, location_a, location_b, radius):
+
         import utils
 
         path_line = location_a, location_b
 
-        cell_border_offsets = list(itertools.product((-1, 0, +1), repeat=2))
+        (a_r, a_c), (b_r, b_c) = location_a, location_b
+
+        # Every point of the segment is at least this far from any non-navigable cell
+        clearance_map = self.get_clearance_map()
+        guaranteed_clearance = (clearance_map[a_r, a_c] + clearance_map[b_r, b_c]
+                                - utils.distance(location_a, location_b)) / 2.0
+        if guaranteed_clearance > radius + self.CLEAR_SHOT_TOLERANCE:
+            return True
+
+        # Otherwise, only examine the cells in the corridor swept by the segment
+        delta_r, delta_c = b_r - a_r, b_c - a_c
+        reach = radius + self.CLEAR_SHOT_TOLERANCE
+
+        first_row = max(0, int(np.ceil(min(a_r, b_r) - reach)))
+        last_row = min(self.num_rows - 1, int(np.floor(max(a_r, b_r) + reach)))
+        rows = np.arange(first_row, last_row + 1)
 
-        for r in range(self.num_rows):
-            for c in range(self.num_cols):
-                for offset_r, offset_c in cell_border_offsets:
+        # The part of the segment within reach of each row
+        if delta_r == 0:
+            t_min, t_max = np.zeros(len(rows)), np.ones(len(rows))
+        else:
+            t_1, t_2 = (rows - reach - a_r) / float(delta_r), (rows + reach - a_r) / float(delta_r)
+            t_min, t_max = np.maximum(np.minimum(t_1, t_2), 0.0), np.minimum(np.maximum(t_1, t_2), 1.0)
+
+        c_1, c_2 = a_c + t_min * delta_c, a_c + t_max * delta_c
+        first_cols = np.maximum(np.ceil(np.minimum(c_1, c_2) - reach), 0).astype(int)
+        last_cols = np.minimum(np.floor(np.maximum(c_1, c_2) + reach), self.num_cols - 1).astype(int)
+        last_cols[t_min > t_max] = -1
+
+        first_col, last_col = first_cols.min(), last_cols.max()
+        if first_col > last_col:
+            return True
+
+        cols = np.arange(first_col, last_col + 1)
+        in_corridor = (cols >= first_cols[:, np.newaxis]) & (cols <= last_cols[:, np.newaxis])
+        is_blocked = self.navigation_grid_array[first_row:last_row + 1, first_col:last_col + 1] != NAVIGABLE_CELL
+
+        candidate_rows, candidate_cols = np.nonzero(in_corridor & is_blocked)
+        if len(candidate_rows) == 0:
+            return True
 
-                    new_r, new_c = r + offset_r, c + offset_c
+        candidate_cells = np.column_stack((candidate_rows + first_row, candidate_cols + first_col))
+        candidate_distances = utils.minimumDistances(path_line, candidate_cells)
 
-                    if new_r < 0 or new_r >= self.num_rows or new_c < 0 or new_c >= self.num_cols:
-                        continue
+        if np.any(candidate_distances < radius - self.CLEAR_SHOT_TOLERANCE):
+            return False
 
-                    if utils.minimumDistance(path_line, (new_r, new_c)) <= radius:
-                        if self.get_cell(new_r, new_c) is not NAVIGABLE_CELL:
-                            return False
+        # Settle the cells right at the radius with the scalar computation, so rounding can't change the outcome
+        for cell, candidate_distance in zip(candidate_cells, candidate_distances):
+            if abs(candidate_distance - radius) <= self.CLEAR_SHOT_TOLERANCE:
+                if utils.minimumDistance(path_line, tuple(cell.tolist())) <= radius:
+                    return False
 
         return True
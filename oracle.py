@@ -0,0 +1,362 @@
+import collections
+import heapq
+import os
+import numpy as np
+from constants import NAVIGABLE_CELL, NEIGHBOR_OFFSETS
+import utils
+from instrumentation import instrumentation
+
+
+class AccessCellDistanceOracle(object):
+    """
+    Unit-cost BFS distances (and predecessors) from every shelve access cell and depot of a warehouse to every cell
+    of that warehouse. Rows of the matrices are sources, columns are the flattened (r, c) cells of the grid. The
+    predecessor of a cell is its lowest-index neighbor one step closer to the source, so that repairs after cells are
+    flipped give the same shortest path trees as a fresh BFS.
+    """
+
+    UNREACHABLE = -1
+
+    def __init__(self, gt_library_warehouse, depots=()):
+
+        self.gt_library_warehouse = gt_library_warehouse
+        self.num_cells = gt_library_warehouse.num_rows * gt_library_warehouse.num_cols
+
+        self.sources = []
+        self.source_indices = {}
+
+        self.distances = np.empty((0, self.num_cells), dtype=np.int32)
+        self.predecessors = np.empty((0, self.num_cells), dtype=np.int32)
+
+        # Every shelve is reached through the navigable cell next to it
+        access_cells = [
+            utils.get_navigable_cell_coordinate_near_book(shelve_location, gt_library_warehouse)
+            for shelve_location in sorted(gt_library_warehouse.locations_to_shelve_tags)
+        ]
+
+        self.add_sources(access_cells + list(depots))
+
+    @classmethod
+    def load(cls, gt_library_warehouse, directory):
+        """ Memory-maps an oracle saved in the given directory, without running any BFS. """
+
+        distance_oracle = cls.__new__(cls)
+
+        distance_oracle.gt_library_warehouse = gt_library_warehouse
+        distance_oracle.num_cells = gt_library_warehouse.num_rows * gt_library_warehouse.num_cols
+
+        sources = np.load(os.path.join(directory, 'oracle_sources.npy'))
+        distance_oracle.sources = [tuple(cell) for cell in sources.tolist()]
+        distance_oracle.source_indices = {cell: i for i, cell in enumerate(distance_oracle.sources)}
+
+        distance_oracle.distances = np.load(os.path.join(directory, 'oracle_distances.npy'), mmap_mode='r')
+        distance_oracle.predecessors = np.load(os.path.join(directory, 'oracle_predecessors.npy'), mmap_mode='r')
+
+        assert distance_oracle.distances.shape == (len(distance_oracle.sources), distance_oracle.num_cells)
+
+        return distance_oracle
+
+    def save(self, directory):
+        np.save(os.path.join(directory, 'oracle_sources.npy'), np.array(self.sources, dtype=np.int32).reshape(-1, 2))
+        np.save(os.path.join(directory, 'oracle_distances.npy'), self.distances)
+        np.save(os.path.join(directory, 'oracle_predecessors.npy'), self.predecessors)
+
+    def add_sources(self, cells):
+        """ Runs a BFS from each of the given cells that isn't already a source and stores the results. """
+
+        new_sources = []
+        for cell in cells:
+            cell = tuple(cell)
+            if cell not in self.source_indices and cell not in new_sources:
+                new_sources.append(cell)
+
+        if not new_sources:
+            return
+
+        distances, predecessors = [], []
+        for cell in new_sources:
+            assert self.gt_library_warehouse.get_cell(*cell) is NAVIGABLE_CELL, "Sources must be navigable."
+
+            source_distances, source_predecessors = self._bfs(cell)
+            instrumentation.increment('bfs_runs')
+            distances.append(source_distances)
+            predecessors.append(source_predecessors)
+
+        for cell in new_sources:
+            self.source_indices[cell] = len(self.sources)
+            self.sources.append(cell)
+
+        self.distances = np.vstack([self.distances, np.array(distances, dtype=np.int32)])
+        self.predecessors = np.vstack([self.predecessors, np.array(predecessors, dtype=np.int32)])
+
+    def _bfs(self, source):
+        """ Unit-cost BFS over the neighbor lists of the cells, returning flat distance and predecessor lists. """
+
+        neighbor_lists = self.gt_library_warehouse.get_neighbor_lists()
+
+        distances = [self.UNREACHABLE] * self.num_cells
+        predecessors = [-1] * self.num_cells
+
+        source_index = self.get_cell_index(source)
+        distances[source_index] = 0
+
+        queue = collections.deque([source_index])
+        while queue:
+            index = queue.popleft()
+
+            for new_index in neighbor_lists[index]:
+                if distances[new_index] != self.UNREACHABLE:
+                    # Another neighbor one step closer, which wins ties if it comes first
+                    if distances[new_index] == distances[index] + 1 and index < predecessors[new_index]:
+                        predecessors[new_index] = index
+
+                    continue
+
+                distances[new_index] = distances[index] + 1
+                predecessors[new_index] = index
+                queue.append(new_index)
+
+        return distances, predecessors
+
+    def _get_predecessor(self, neighbor_lists, distances, index):
+        """ Returns the lowest-index neighbor one step closer to the source than the given cell, or -1 if none is. """
+
+        distance = distances[index]
+        if distance == self.UNREACHABLE or distance == 0:
+            return -1
+
+        return min(new_index for new_index in neighbor_lists[index] if distances[new_index] == distance - 1)
+
+    def block_cells(self, cells):
+        """
+        Repairs the distances after the given cells became obstacles, once the neighbor lists no longer connect them.
+        For every source, only the subtrees of its shortest path tree hanging below the cells are invalidated, and
+        then filled in again from the valid cells around them, closest first.
+        """
+
+        self._make_writable()
+
+        indices = [self.get_cell_index(cell) for cell in cells]
+
+        self.distances[:, indices] = self.UNREACHABLE
+        self.predecessors[:, indices] = -1
+
+        # The cells right below the blocked ones in the shortest path trees
+        children, parents = [], []
+        for index, cell in zip(indices, cells):
+            for neighbor_index in self._get_grid_neighbor_indices(cell):
+                if neighbor_index not in indices:
+                    children.append(neighbor_index)
+                    parents.append(index)
+
+        if not children:
+            return
+
+        is_child = self.predecessors[:, children] == np.array(parents)
+
+        for source_index in np.flatnonzero(is_child.any(axis=1)):
+            roots = [child for child, is_source_child in zip(children, is_child[source_index]) if is_source_child]
+            self._repair_subtrees(source_index, roots)
+
+        instrumentation.increment('oracle_block_repairs')
+
+    def _repair_subtrees(self, source_index, roots):
+        neighbor_lists = self.gt_library_warehouse.get_neighbor_lists()
+
+        distances = self.distances[source_index].tolist()
+        predecessors = self.predecessors[source_index].tolist()
+
+        # Every cell whose shortest path went through one of the roots
+        invalid = set(roots)
+        queue = collections.deque(roots)
+        while queue:
+            index = queue.popleft()
+
+            for new_index in neighbor_lists[index]:
+                if predecessors[new_index] == index and new_index not in invalid:
+                    invalid.add(new_index)
+                    queue.append(new_index)
+
+        for index in invalid:
+            distances[index] = self.UNREACHABLE
+            predecessors[index] = -1
+
+        # Seed them from their valid neighbors, whose distances haven't changed
+        heap = []
+        for index in invalid:
+            for new_index in neighbor_lists[index]:
+                if new_index in invalid or distances[new_index] == self.UNREACHABLE:
+                    continue
+
+                if distances[index] == self.UNREACHABLE or distances[new_index] + 1 < distances[index]:
+                    distances[index] = distances[new_index] + 1
+                    predecessors[index] = new_index
+
+            if distances[index] != self.UNREACHABLE:
+                heap.append((distances[index], index))
+
+        heapq.heapify(heap)
+        while heap:
+            distance, index = heapq.heappop(heap)
+            if distance > distances[index]:
+                continue
+
+            for new_index in neighbor_lists[index]:
+                if new_index in invalid and (
+                        distances[new_index] == self.UNREACHABLE or distance + 1 < distances[new_index]):
+                    distances[new_index] = distance + 1
+                    predecessors[new_index] = index
+                    heapq.heappush(heap, (distance + 1, new_index))
+
+        for index in invalid:
+            predecessors[index] = self._get_predecessor(neighbor_lists, distances, index)
+
+        invalid = list(invalid)
+        self.distances[source_index, invalid] = [distances[index] for index in invalid]
+        self.predecessors[source_index, invalid] = [predecessors[index] for index in invalid]
+
+    def unblock_cell(self, cell):
+        """
+        Repairs the distances after the given cell became navigable, once the neighbor lists connect it. For every
+        source, the cell gets its distance from its closest neighbor, and the decrease is propagated breadth-first to
+        the cells it brings closer.
+        """
+
+        self._make_writable()
+
+        neighbor_lists = self.gt_library_warehouse.get_neighbor_lists()
+
+        index = self.get_cell_index(cell)
+        neighbor_indices = neighbor_lists[index]
+
+        if not neighbor_indices:
+            return
+
+        neighbor_distances = self.distances[:, neighbor_indices].astype(np.int64)
+        neighbor_distances[neighbor_distances == self.UNREACHABLE] = np.iinfo(np.int32).max
+
+        closest_neighbors = np.argmin(neighbor_distances, axis=1)
+        new_distances = neighbor_distances[np.arange(len(self.sources)), closest_neighbors] + 1
+
+        is_reached = new_distances < np.iinfo(np.int32).max
+        self.distances[is_reached, index] = new_distances[is_reached]
+        self.predecessors[is_reached, index] = np.array(neighbor_indices)[closest_neighbors[is_reached]]
+
+        # Neighbors as far as before, which now have this cell as a predecessor if it comes first
+        for neighbor_index, neighbor_distances_from_sources in zip(neighbor_indices, neighbor_distances.T):
+            is_tied = is_reached & (neighbor_distances_from_sources == new_distances + 1) & \
+                (index < self.predecessors[:, neighbor_index])
+            self.predecessors[is_tied, neighbor_index] = index
+
+        # Only sources for which going through this cell gets some neighbor closer need to propagate
+        is_improving = np.any(neighbor_distances > (new_distances + 1)[:, np.newaxis], axis=1) & is_reached
+
+        for source_index in np.flatnonzero(is_improving):
+            distances = self.distances[source_index].tolist()
+
+            changed = []
+            queue = collections.deque([index])
+            while queue:
+                changed_index = queue.popleft()
+
+                for new_index in neighbor_lists[changed_index]:
+                    if distances[new_index] != self.UNREACHABLE and distances[new_index] <= distances[changed_index] + 1:
+                        continue
+
+                    distances[new_index] = distances[changed_index] + 1
+                    changed.append(new_index)
+                    queue.append(new_index)
+
+            # The cells that got closer and their neighbors may have new predecessors
+            affected = set(changed)
+            for changed_index in changed:
+                affected.update(neighbor_lists[changed_index])
+
+            affected = list(affected)
+            self.distances[source_index, changed] = [distances[changed_index] for changed_index in changed]
+            self.predecessors[source_index, affected] = [
+                self._get_predecessor(neighbor_lists, distances, affected_index) for affected_index in affected]
+
+        instrumentation.increment('oracle_unblock_repairs')
+
+    def _make_writable(self):
+        # Distances memory-mapped from the warehouse cache are read-only
+        if not self.distances.flags.writeable:
+            self.distances = np.array(self.distances)
+            self.predecessors = np.array(self.predecessors)
+
+    def _get_grid_neighbor_indices(self, cell):
+        r, c = cell
+        return [
+            self.get_cell_index((r + offset_r, c + offset_c)) for offset_r, offset_c in NEIGHBOR_OFFSETS
+            if 0 <= r + offset_r < self.gt_library_warehouse.num_rows
+            and 0 <= c + offset_c < self.gt_library_warehouse.num_cols
+        ]
+
+    def get_shortest_path_tree(self, cell):
+        """
+        Returns the distances from the given cell to every cell and the predecessors of every cell on its shortest
+        paths, as flat lists: the rows of a source, or a BFS from any other navigable cell.
+        """
+
+        cell = tuple(cell)
+
+        if cell in self.source_indices:
+            source_index = self.source_indices[cell]
+            return self.distances[source_index].tolist(), self.predecessors[source_index].tolist()
+
+        assert self.gt_library_warehouse.get_cell(*cell) is NAVIGABLE_CELL, "Cells must be navigable."
+
+        instrumentation.increment('bfs_runs')
+
+        return self._bfs(cell)
+
+    def get_source_index(self, cell):
+        try:
+            return self.source_indices[tuple(cell)]
+        except KeyError:
+            raise ValueError("Cell %s is not a source of this oracle" % str(cell))
+
+    def get_cell_index(self, cell):
+        r, c = cell
+        return r * self.gt_library_warehouse.num_cols + c
+
+    def get_distance(self, cell_a, cell_b):
+        """ Returns the walking distance from source cell_a to any cell_b. """
+
+        distance = int(self.distances[self.get_source_index(cell_a), self.get_cell_index(cell_b)])
+
+        if distance == self.UNREACHABLE:
+            raise ValueError("No path between %s and %s" % (str(cell_a), str(cell_b)))
+
+        return distance
+
+    def get_distance_matrix(self, source_cells, target_cells):
+        """ Returns the (len(source_cells), len(target_cells)) matrix of walking distances between the cells. """
+
+        rows = [self.get_source_index(cell) for cell in source_cells]
+        cols = [self.get_cell_index(cell) for cell in target_cells]
+
+        distance_matrix = self.distances[np.ix_(rows, cols)]
+
+        if np.any(distance_matrix == self.UNREACHABLE):
+            raise ValueError("Some of the given cells are not connected")
+
+        return distance_matrix
+
+    def get_path(self, cell_a, cell_b):
+        """ Returns a shortest cell-by-cell path from source cell_a to cell_b, inclusive of both. """
+
+        num_cols = self.gt_library_warehouse.num_cols
+        source_predecessors = self.predecessors[self.get_source_index(cell_a)]
+
+        # Ensures cell_b is reachable
+        self.get_distance(cell_a, cell_b)
+
+        path = [tuple(cell_b)]
+        index = self.get_cell_index(cell_b)
+        while path[-1] != tuple(cell_a):
+            index = int(source_predecessors[index])
+            path.append((index // num_cols, index % num_cols))
+
+        return path[::-1]
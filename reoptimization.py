@@ -0,0 +1,136 @@
+import logging
+import os
+import tsp_solvers
+import utils
+from models import Book
+from instrumentation import instrumentation
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+
+def reoptimize_pick_path_as_dict(gt_library_warehouse, pick_path_as_dict, added_book_tags=(), removed_book_tags=(),
+                                 time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET, leg_router=utils.DEFAULT_LEG_ROUTER):
+    # type: (GTLibraryGridWarehouse, dict, list, list, float, str) -> (dict, int)
+    """
+    Updates an existing pick path (its pickPathInformation) for books added to or removed from its order, without
+    solving the TSP again. Shelves no longer visited are dropped from the tour, new shelves are inserted where they add
+    the least walking, and the tour is then improved with 2-opt and Or-opt moves within time_budget seconds. Only the
+    legs between shelves that weren't consecutive before are routed (and shortcut) again. The pick path must have been
+    generated with the same leg_router.
+    :return: The updated pickPathInformation and how much longer (negative if shorter) its tour is.
+    """
+
+    ordered_pick_path = pick_path_as_dict['orderedPickPath']
+    source = tuple(ordered_pick_path[0]['cellByCellPathToTargetBookLocation'][0])
+
+    old_books_and_locations = [
+        (Book.from_dict(book_and_location['book']), tuple(book_and_location['location']))
+        for book_and_location in pick_path_as_dict['orderedBooksAndLocations']
+    ]
+    old_unordered_books_and_locations = [
+        (Book.from_dict(book_and_location['book']), tuple(book_and_location['location']))
+        for book_and_location in pick_path_as_dict['unorderedBooksAndLocations']
+    ]
+
+    old_tags = set(book.tag for book, _ in old_books_and_locations)
+
+    unknown_removed_tags = sorted(set(removed_book_tags) - old_tags)
+    if unknown_removed_tags:
+        raise ValueError("Books %s aren't in the pick path" % ', '.join(unknown_removed_tags))
+
+    already_added_tags = sorted(set(added_book_tags) & (old_tags - set(removed_book_tags)))
+    if already_added_tags:
+        raise ValueError("Books %s are already in the pick path" % ', '.join(already_added_tags))
+
+    with instrumentation.stage('book_locations'):
+        added_book_indices = gt_library_warehouse.catalog.get_book_indices(list(added_book_tags))
+        added_books_and_locations = zip(
+            gt_library_warehouse.catalog.get_books(added_book_indices),
+            [tuple(location) for location in gt_library_warehouse.catalog.get_locations(added_book_indices).tolist()])
+
+    removed_book_tags = set(removed_book_tags)
+    books_and_locations = [(book, location) for book, location in old_unordered_books_and_locations
+                           if book.tag not in removed_book_tags] + added_books_and_locations
+
+    # Tours visit every shelve once, books on the same shelve are picked one after the other
+    old_tour_locations = [source]
+    for _, location in old_books_and_locations:
+        if location != old_tour_locations[-1]:
+            old_tour_locations.append(location)
+    old_tour_locations.append(source)
+
+    with instrumentation.stage('distance_matrix'):
+        locations, distance_matrix = utils.get_distance_matrix_on_book_locations(
+            gt_library_warehouse,
+            old_tour_locations[1:-1] + [location for _, location in added_books_and_locations],
+            source,
+            leg_router,
+        )
+
+    nodes = {location: node for node, location in enumerate(locations)}
+    old_tour = [nodes[location] for location in old_tour_locations]
+
+    with instrumentation.stage('tsp'):
+        visited_nodes = set(nodes[location] for _, location in books_and_locations)
+        tour = [node for node in old_tour if node in visited_nodes or node == 0]
+
+        added_nodes = []
+        for _, location in added_books_and_locations:
+            if nodes[location] not in tour and nodes[location] not in added_nodes:
+                added_nodes.append(nodes[location])
+
+        tour = tsp_solvers.insert_cheapest(distance_matrix, tour, added_nodes)
+        tour = tsp_solvers.improve_tour(distance_matrix, tour, time_budget=time_budget)
+
+    old_cost = tsp_solvers.get_tour_cost(distance_matrix, old_tour)
+    cost = tsp_solvers.get_tour_cost(distance_matrix, tour)
+
+    logger.info('Re-optimized pick path for %d added and %d removed books, its tour went from %s to %s.',
+                len(added_book_tags), len(removed_book_tags), old_cost, cost)
+
+    with instrumentation.stage('reintroduce_duplicates'):
+        ordered_books, ordered_locations = utils.reintroduce_duplicate_column_locations(
+            books_and_locations, source, tuple(locations[node] for node in tour))
+
+    # Legs between the same two locations, in either direction, are kept as they were
+    old_legs = {}
+    old_ordered_locations = [source] + [location for _, location in old_books_and_locations] + [source]
+    for i, step in enumerate(ordered_pick_path):
+        leg = [tuple(cell) for cell in step['cellByCellPathToTargetBookLocation']]
+        old_legs[old_ordered_locations[i], old_ordered_locations[i + 1]] = leg
+        old_legs.setdefault((old_ordered_locations[i + 1], old_ordered_locations[i]), leg[::-1])
+
+    router = utils.get_leg_router(gt_library_warehouse, source, leg_router)
+
+    pick_path_in_library = []
+    for n1, n2 in zip(ordered_locations[:-1], ordered_locations[1:]):
+        if (n1, n2) in old_legs:
+            pick_path_in_library.append(old_legs[n1, n2])
+            continue
+
+        with instrumentation.stage('library_path'):
+            leg = utils.get_leg_in_library(gt_library_warehouse, router, n1, n2, source)
+
+        if leg_router != utils.ANY_ANGLE_LEG_ROUTER:
+            with instrumentation.stage('shortcutting'):
+                leg = utils.shortcut_paths(gt_library_warehouse, leg)
+
+        pick_path_in_library.append(leg)
+
+        instrumentation.increment('rerouted_legs')
+
+    with instrumentation.stage('validation'):
+        utils.assert_library_pick_path_is_proper(pick_path_in_library, ordered_locations, source)
+        utils.assert_library_pick_path_has_cost(pick_path_in_library, cost, len(ordered_books[1:-1]))
+
+    with instrumentation.stage('packaging'):
+        reoptimized_pick_path_as_dict = utils.get_pick_path_as_dict(
+            [book for book, _ in books_and_locations],
+            [location for _, location in books_and_locations],
+            ordered_books,
+            ordered_locations,
+            pick_path_in_library,
+        )
+
+    return reoptimized_pick_path_as_dict, cost - old_cost
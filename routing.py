@@ -0,0 +1,350 @@
+import collections
+import heapq
+import numpy as np
+from constants import NAVIGABLE_CELL, SUBJECT_RADIUS
+import utils
+from instrumentation import instrumentation
+
+
+class GridRouter(object):
+    """
+    A* over the unit-cost neighbor lists of the navigable cells, guided by the Manhattan distance, which never
+    overestimates on a 4-connected grid, so routes are shortest. The search state lives in flat buffers allocated once
+    and reused by every search: an entry only counts when its stamp is the generation of the current search, so the
+    buffers never have to be cleared.
+    """
+
+    def __init__(self, gt_library_warehouse):
+
+        self.num_cols = gt_library_warehouse.num_cols
+        self.num_cells = gt_library_warehouse.num_rows * gt_library_warehouse.num_cols
+
+        # Shared with the warehouse, so flipped cells are picked up
+        self._neighbor_lists = gt_library_warehouse.get_neighbor_lists()
+
+        self._rows = [index // self.num_cols for index in range(self.num_cells)]
+        self._cols = [index % self.num_cols for index in range(self.num_cells)]
+
+        self._costs = [0] * self.num_cells
+        self._parents = [-1] * self.num_cells
+        self._stamps = [0] * self.num_cells
+        self._closed_stamps = [0] * self.num_cells
+        self._generation = 0
+
+    def get_path(self, cell_a, cell_b):
+        """ Returns a shortest cell-by-cell path between two navigable cells, inclusive of both. """
+
+        neighbor_lists, rows, cols = self._neighbor_lists, self._rows, self._cols
+        costs, parents, stamps, closed_stamps = self._costs, self._parents, self._stamps, self._closed_stamps
+
+        self._generation += 1
+        generation = self._generation
+
+        start = cell_a[0] * self.num_cols + cell_a[1]
+        goal_r, goal_c = cell_b
+        goal = goal_r * self.num_cols + goal_c
+
+        costs[start], parents[start], stamps[start] = 0, -1, generation
+
+        # Ties on the estimated total go to the deepest cell, which is the closest to the goal
+        heap = [(abs(goal_r - rows[start]) + abs(goal_c - cols[start]), 0, start)]
+        expansions = 0
+
+        while heap:
+            _, negative_cost, index = heapq.heappop(heap)
+
+            if index == goal:
+                break
+
+            if closed_stamps[index] == generation:
+                continue
+
+            closed_stamps[index] = generation
+            expansions += 1
+
+            new_cost = 1 - negative_cost
+            for new_index in neighbor_lists[index]:
+                if stamps[new_index] == generation and costs[new_index] <= new_cost:
+                    continue
+
+                costs[new_index], parents[new_index], stamps[new_index] = new_cost, index, generation
+                heapq.heappush(heap, (
+                    new_cost + abs(goal_r - rows[new_index]) + abs(goal_c - cols[new_index]), -new_cost, new_index))
+        else:
+            raise ValueError("No path between %s and %s" % (str(cell_a), str(cell_b)))
+
+        instrumentation.increment('astar_expansions', expansions)
+
+        path = [goal]
+        while path[-1] != start:
+            path.append(parents[path[-1]])
+
+        return [(rows[index], cols[index]) for index in reversed(path)]
+
+
+class AisleGraph(object):
+    """
+    The aisle-level graph of a warehouse, whose nodes are the shelve access cells, the depots and the junctions where
+    the corridors in front of the aisles meet the cross-aisles. Two nodes are joined by an edge when the shortest path
+    between them in the distance oracle passes through no other node, weighted by its length. Routes are searched for on
+    these few nodes, so a search scales with the number of aisles rather than with the area of the grid, and only the
+    edges of the route found are expanded back to cells, along the shortest path trees of the oracle.
+    """
+
+    def __init__(self, gt_library_warehouse, depots=()):
+
+        self.num_cols = gt_library_warehouse.num_cols
+
+        distance_oracle = gt_library_warehouse.get_distance_oracle(depots=depots)
+
+        self.nodes = list(distance_oracle.sources)
+        self.nodes.extend(sorted(set(get_aisle_junctions(gt_library_warehouse)) - set(self.nodes)))
+        self.node_indices = {node: i for i, node in enumerate(self.nodes)}
+
+        node_cell_indices = [self._get_cell_index(node) for node in self.nodes]
+        is_node_cell_index = set(node_cell_indices)
+
+        self._trees = [distance_oracle.get_shortest_path_tree(node) for node in self.nodes]
+
+        # edges[i] holds the (length, j) of the edges from node i
+        self.edges = []
+        for i, (distances, predecessors) in enumerate(self._trees):
+            node_edges = []
+
+            for j, cell_index in enumerate(node_cell_indices):
+                if j == i or distances[cell_index] == distance_oracle.UNREACHABLE:
+                    continue
+
+                # Walk back towards node i until the first node on the way
+                index = predecessors[cell_index]
+                while index != node_cell_indices[i] and index not in is_node_cell_index:
+                    index = predecessors[index]
+
+                if index == node_cell_indices[i]:
+                    node_edges.append((distances[cell_index], j))
+
+            self.edges.append(node_edges)
+
+    def __contains__(self, cell):
+        return tuple(cell) in self.node_indices
+
+    def _get_cell_index(self, cell):
+        r, c = cell
+        return r * self.num_cols + c
+
+    def _get_node_index(self, cell):
+        try:
+            return self.node_indices[tuple(cell)]
+        except KeyError:
+            raise ValueError("Cell %s is not a node of the aisle graph" % str(cell))
+
+    def _search(self, cell_a, cell_b):
+        """ Dijkstra over the nodes, returning the walking distance between the two cells and the nodes on the way. """
+
+        start, goal = self._get_node_index(cell_a), self._get_node_index(cell_b)
+
+        costs = {start: 0}
+        parents = {start: None}
+        closed = set()
+
+        heap = [(0, start)]
+        while heap:
+            cost, i = heapq.heappop(heap)
+
+            if i == goal:
+                break
+
+            if i in closed:
+                continue
+
+            closed.add(i)
+
+            for length, j in self.edges[i]:
+                new_cost = cost + length
+                if j not in costs or new_cost < costs[j]:
+                    costs[j], parents[j] = new_cost, i
+                    heapq.heappush(heap, (new_cost, j))
+        else:
+            raise ValueError("No path between %s and %s" % (str(cell_a), str(cell_b)))
+
+        instrumentation.increment('aisle_graph_expansions', len(closed))
+
+        node_path = [goal]
+        while parents[node_path[-1]] is not None:
+            node_path.append(parents[node_path[-1]])
+
+        return costs[goal], node_path[::-1]
+
+    def get_distance(self, cell_a, cell_b):
+        """ Returns the walking distance between two nodes. """
+        return self._search(cell_a, cell_b)[0]
+
+    def get_path(self, cell_a, cell_b):
+        """ Returns a shortest cell-by-cell path between two nodes, inclusive of both. """
+
+        _, node_path = self._search(cell_a, cell_b)
+
+        path = [self.nodes[node_path[0]]]
+        for i, j in zip(node_path[:-1], node_path[1:]):
+            _, predecessors = self._trees[i]
+
+            # The cells of the edge from node j back to node i
+            edge_path = [self._get_cell_index(self.nodes[j])]
+            start = self._get_cell_index(self.nodes[i])
+            while predecessors[edge_path[-1]] != start:
+                edge_path.append(predecessors[edge_path[-1]])
+
+            path.extend(divmod(index, self.num_cols) for index in reversed(edge_path))
+
+        return path
+
+
+def get_aisle_junctions(gt_library_warehouse):
+    """
+    Returns the navigable cells right past either end of the row of access cells in front of every aisle, where its
+    corridor meets the cross-aisles.
+    """
+
+    access_cells_by_aisle = collections.defaultdict(set)
+    for shelve_location, shelve_tag in gt_library_warehouse.locations_to_shelve_tags.items():
+        access_cells_by_aisle[utils.get_shelve_aisle_from_tag(shelve_tag)].add(
+            utils.get_navigable_cell_coordinate_near_book(shelve_location, gt_library_warehouse))
+
+    junctions = []
+    for aisle in sorted(access_cells_by_aisle):
+        access_cells = sorted(access_cells_by_aisle[aisle])
+        (first_r, first_c), (last_r, last_c) = access_cells[0], access_cells[-1]
+
+        for r, c in ((first_r, first_c - 1), (last_r, last_c + 1)):
+            if 0 <= c < gt_library_warehouse.num_cols and gt_library_warehouse.get_cell(r, c) is NAVIGABLE_CELL:
+                junctions.append((r, c))
+
+    return junctions
+
+
+class AnyAngleRouter(object):
+    """
+    Any-angle routes and walking distances for a subject of the given radius, from Theta* searches over the navigable
+    cells. A cell's parent can be any cell in clear line of sight of it (see is_clear_shot), not just a neighbor, so
+    routes come out as straight segments between turning points and need no shortcutting. Every search runs from one
+    cell to all the others, closest first, and is kept in an LRU cache so pick paths through the same cells share it.
+    Theta* distances aren't quite symmetric, so the shorter of the two directions is used both ways.
+    """
+
+    SEARCH_CACHE_SIZE = 256
+
+    def __init__(self, gt_library_warehouse, radius=SUBJECT_RADIUS):
+
+        self.gt_library_warehouse = gt_library_warehouse
+        self.radius = radius
+
+        self.num_cols = gt_library_warehouse.num_cols
+        self.num_cells = gt_library_warehouse.num_rows * gt_library_warehouse.num_cols
+
+        self._neighbor_lists = gt_library_warehouse.get_neighbor_lists()
+        self._searches = utils.LRUCache(self.SEARCH_CACHE_SIZE)
+
+    def _get_cell_index(self, cell):
+        r, c = cell
+        return r * self.num_cols + c
+
+    def _get_cell(self, index):
+        return index // self.num_cols, index % self.num_cols
+
+    def _get_search(self, cell):
+        """ Returns the distances from the cell to every cell and the parents of every cell on its routes. """
+
+        cell = tuple(cell)
+
+        search = self._searches.get(cell)
+        if search is None:
+            search = self._search(cell)
+            self._searches.put(cell, search)
+
+        return search
+
+    def _search(self, cell):
+        neighbor_lists = self._neighbor_lists
+        is_clear_shot = self.gt_library_warehouse.is_clear_shot
+        num_cols = self.num_cols
+
+        costs = [np.inf] * self.num_cells
+        parents = [-1] * self.num_cells
+        is_closed = [False] * self.num_cells
+
+        start = self._get_cell_index(cell)
+        costs[start], parents[start] = 0.0, start
+
+        heap = [(0.0, start)]
+        while heap:
+            cost, index = heapq.heappop(heap)
+            if is_closed[index]:
+                continue
+
+            is_closed[index] = True
+            parent = parents[index]
+            parent_cell = divmod(parent, num_cols)
+
+            for new_index in neighbor_lists[index]:
+                if is_closed[new_index]:
+                    continue
+
+                new_cell = divmod(new_index, num_cols)
+
+                # Walk straight from the parent if it can be seen, otherwise step from this cell
+                if parent != index and is_clear_shot(parent_cell, new_cell, self.radius):
+                    new_parent = parent
+                    new_cost = costs[parent] + utils.distance(parent_cell, new_cell)
+                else:
+                    new_parent = index
+                    new_cost = cost + 1.0
+
+                if new_cost < costs[new_index]:
+                    costs[new_index], parents[new_index] = new_cost, new_parent
+                    heapq.heappush(heap, (new_cost, new_index))
+
+        instrumentation.increment('theta_star_searches')
+
+        return costs, parents
+
+    def get_distance(self, cell_a, cell_b):
+        """ Returns the any-angle walking distance between the two cells. """
+
+        distance = min(self._get_search(cell_a)[0][self._get_cell_index(cell_b)],
+                       self._get_search(cell_b)[0][self._get_cell_index(cell_a)])
+
+        if distance == np.inf:
+            raise ValueError("No path between %s and %s" % (str(cell_a), str(cell_b)))
+
+        return distance
+
+    def get_distance_matrix(self, source_cells, target_cells):
+        """ Returns the (len(source_cells), len(target_cells)) matrix of any-angle walking distances between the cells. """
+
+        return np.array([[self.get_distance(cell_a, cell_b) for cell_b in target_cells] for cell_a in source_cells])
+
+    def get_path(self, cell_a, cell_b):
+        """ Returns the turning points of the any-angle route between the two cells, inclusive of both. """
+
+        cell_a, cell_b = tuple(cell_a), tuple(cell_b)
+
+        # Follow the search of the direction get_distance picks
+        costs_from_a, parents_from_a = self._get_search(cell_a)
+        costs_from_b, parents_from_b = self._get_search(cell_b)
+
+        if costs_from_a[self._get_cell_index(cell_b)] <= costs_from_b[self._get_cell_index(cell_a)]:
+            return self._get_path_from_search(parents_from_a, cell_a, cell_b)
+
+        return self._get_path_from_search(parents_from_b, cell_b, cell_a)[::-1]
+
+    def _get_path_from_search(self, parents, cell_a, cell_b):
+        # Ensures cell_b is reachable
+        self.get_distance(cell_a, cell_b)
+
+        start = self._get_cell_index(cell_a)
+
+        path = [self._get_cell_index(cell_b)]
+        while path[-1] != start:
+            path.append(parents[path[-1]])
+
+        return [self._get_cell(index) for index in reversed(path)]
@@ -0,0 +1,264 @@
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import SocketServer
+import threading
+import time
+import numpy as np
+import main
+import tsp_solvers
+import utils
+from instrumentation import instrumentation
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger, logging_level=logging.INFO)
+
+# Longest a request waits for others to share its solver call, in seconds
+DEFAULT_COALESCING_WINDOW = 0.005
+
+# Most orders solved in one shared solver call
+DEFAULT_MAX_BATCH_SIZE = main.PICK_PATH_BATCH_SIZE
+
+
+class PickPathService(object):
+    """
+    Keeps a warehouse and its precomputed structures loaded and generates pick paths for concurrent requests. Requests
+    that arrive within coalescing_window seconds of each other are generated together, so that the TSPs of same-size
+    orders are solved in one batched call. With more than one worker, batches are generated in a pool of processes,
+    up to one batch per worker at a time.
+    """
+
+    def __init__(self, warehouse_file_path, source, number_of_workers=1, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 coalescing_window=DEFAULT_COALESCING_WINDOW,
+                 max_exact_tsp_locations=tsp_solvers.MAX_EXACT_TSP_LOCATIONS,
+                 tsp_time_budget=tsp_solvers.HEURISTIC_TSP_TIME_BUDGET):
+
+        self.source = tuple(source)
+        self.max_batch_size = max_batch_size
+        self.coalescing_window = coalescing_window
+        self.max_exact_tsp_locations = max_exact_tsp_locations
+        self.tsp_time_budget = tsp_time_budget
+
+        self.gt_library_warehouse = utils.get_warehouse(warehouse_file_path)
+        self.gt_library_warehouse.precompute(depots=[self.source])
+
+        self._pool = None
+        if number_of_workers > 1:
+            self._pool = multiprocessing.Pool(
+                processes=number_of_workers,
+                initializer=main._initialize_worker,
+                initargs=(warehouse_file_path, self.source, instrumentation.enabled, False),
+            )
+
+        self._queue = Queue.Queue()
+
+        for _ in range(number_of_workers):
+            dispatcher = threading.Thread(target=self._dispatch)
+            dispatcher.daemon = True
+            dispatcher.start()
+
+    def get_book_indices(self, request):
+        """
+        Returns the catalog indices of the books of a request, which either lists them, as in {"bookTags": [...]}, or
+        asks for a random order, as in {"numberOfBooks": 10, "seed": 1} (the seed is optional).
+        """
+
+        catalog = self.gt_library_warehouse.catalog
+
+        if 'bookTags' in request:
+            if not request['bookTags']:
+                raise ValueError("bookTags must list at least one book")
+
+            return catalog.get_book_indices(request['bookTags'])
+
+        if 'numberOfBooks' in request:
+            number_of_books = request['numberOfBooks']
+            if not 1 <= number_of_books <= len(catalog):
+                raise ValueError("numberOfBooks must be between 1 and %d" % len(catalog))
+
+            random_state = np.random.RandomState(request.get('seed'))
+            return random_state.choice(a=len(catalog), size=number_of_books, replace=False).tolist()
+
+        raise ValueError("Requests must have either bookTags or numberOfBooks")
+
+    def generate_pick_path_as_dict(self, book_indices):
+        """ Queues an order and waits for its pickPathInformation, generated along with any concurrent orders. """
+
+        pending_order = _PendingOrder(book_indices)
+        self._queue.put(pending_order)
+        pending_order.done.wait()
+
+        if pending_order.error is not None:
+            raise pending_order.error
+
+        return pending_order.pick_path_as_dict
+
+    def _dispatch(self):
+        while True:
+            pending_orders = [self._queue.get()]
+
+            # Wait a little for more orders to share the solver call with
+            deadline = time.time() + self.coalescing_window
+            while len(pending_orders) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    pending_orders.append(self._queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+
+            instrumentation.observe('service_batch_size', len(pending_orders))
+            logger.debug('Generating a batch of %d pick paths.', len(pending_orders))
+
+            try:
+                pick_paths_as_dicts = self._generate_pick_paths_as_dicts(
+                    [pending_order.book_indices for pending_order in pending_orders])
+            except Exception:
+                logger.exception('Failed to generate a batch of %d pick paths, retrying them one by one.',
+                                 len(pending_orders))
+
+                # So that one bad order only fails its own request
+                for pending_order in pending_orders:
+                    self._generate_pending_order(pending_order)
+            else:
+                for pending_order, pick_path_as_dict in zip(pending_orders, pick_paths_as_dicts):
+                    pending_order.pick_path_as_dict = pick_path_as_dict
+                    pending_order.done.set()
+
+    def _generate_pending_order(self, pending_order):
+        try:
+            pending_order.pick_path_as_dict, = self._generate_pick_paths_as_dicts([pending_order.book_indices])
+        except Exception as e:
+            logger.exception('Failed to generate a pick path.')
+            pending_order.error = e
+
+        pending_order.done.set()
+
+    def _generate_pick_paths_as_dicts(self, orders_book_indices):
+        arguments = (orders_book_indices, self.source, self.max_exact_tsp_locations, self.tsp_time_budget)
+
+        if self._pool is not None:
+            return self._pool.apply(_generate_pick_paths_as_dicts_in_worker, arguments)
+
+        return _generate_pick_paths_as_dicts(self.gt_library_warehouse, *arguments)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+
+
+class _PendingOrder(object):
+    def __init__(self, book_indices):
+        self.book_indices = book_indices
+        self.done = threading.Event()
+        self.pick_path_as_dict = None
+        self.error = None
+
+
+def _generate_pick_paths_as_dicts(gt_library_warehouse, orders_book_indices, source, max_exact_tsp_locations,
+                                  tsp_time_budget):
+    orders = [main.get_order(gt_library_warehouse, book_indices) for book_indices in orders_book_indices]
+
+    return main.generate_pick_paths_as_dicts(
+        gt_library_warehouse, orders, source, max_exact_tsp_locations, tsp_time_budget)
+
+
+def _generate_pick_paths_as_dicts_in_worker(orders_book_indices, source, max_exact_tsp_locations, tsp_time_budget):
+    # The worker's warehouse, loaded once by main._initialize_worker
+    return _generate_pick_paths_as_dicts(
+        main.worker_gt_library_warehouse, orders_book_indices, source, max_exact_tsp_locations, tsp_time_budget)
+
+
+class PickPathRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /pick-path with a JSON request (see PickPathService.get_book_indices) responds with
+    {"pickPathInformation": ...}, the same structure as the pick paths written by main.py.
+    """
+
+    def do_POST(self):
+        if self.path != '/pick-path':
+            self._respond(404, {'error': 'Unknown path %s' % self.path})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            book_indices = self.server.pick_path_service.get_book_indices(request)
+        except (ValueError, TypeError, KeyError) as e:
+            self._respond(400, {'error': str(e)})
+            return
+
+        try:
+            pick_path_as_dict = self.server.pick_path_service.generate_pick_path_as_dict(book_indices)
+        except Exception as e:
+            self._respond(500, {'error': str(e)})
+            return
+
+        self._respond(200, {'pickPathInformation': pick_path_as_dict})
+
+    def _respond(self, status, response):
+        body = json.dumps(response, separators=(',', ':'))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - ' + format, self.client_address[0], *args)
+
+
+class PickPathHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, pick_path_service):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, PickPathRequestHandler)
+        self.pick_path_service = pick_path_service
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serves pick paths over HTTP, keeping the warehouse loaded.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--warehouse', default='warehouse.json', help='Warehouse JSON file.')
+    parser.add_argument('--source', type=int, nargs=2, default=[0, 0], metavar=('ROW', 'COL'),
+                        help='Cell every pick path starts and ends at.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes batches are generated in.')
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help='Most orders generated together.')
+    parser.add_argument('--coalescing-window', type=float, default=DEFAULT_COALESCING_WINDOW,
+                        help='Seconds a request waits for others to be generated with.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # Keep per-path logging out of the request latency
+    utils.quiet_per_path_logging()
+
+    args = parse_args()
+
+    service = PickPathService(
+        args.warehouse,
+        args.source,
+        number_of_workers=args.workers,
+        max_batch_size=args.max_batch_size,
+        coalescing_window=args.coalescing_window,
+    )
+
+    server = PickPathHTTPServer((args.host, args.port), service)
+    logger.info('Serving pick paths on http://%s:%d/pick-path.', args.host, args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
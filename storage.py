@@ -0,0 +1,630 @@
+import json
+import mmap
+import os
+import re
+import struct
+import numpy as np
+
+PICK_PATH_FILE_FORMAT_VERSION = '1.2'
+
+# Sidecar files next to JSON and JSON Lines pick path files, holding the byte range of every pick path in them
+PICK_PATH_INDEX_FILE_SUFFIX = '.index'
+
+# Binary pick path files start and end with this magic, the version of the binary layout following the first one
+PICK_PATH_BINARY_FILE_MAGIC = b'PKPB'
+PICK_PATH_BINARY_FILE_FORMAT_VERSION = 1
+
+# The magic and layout version; path ID, path type, numbers of unordered books, ordered books and steps of a record;
+# and the footer: offsets of the catalog and of the index, number of pick paths and the magic again
+_BINARY_FILE_HEADER = struct.Struct('<4sH')
+_BINARY_RECORD_HEADER = struct.Struct('<iIIII')
+_BINARY_FILE_FOOTER = struct.Struct('<QQQ4s')
+_RECORD_LENGTH = struct.Struct('<I')
+
+# Cells and locations are packed as int16 (r, c) pairs, missing target locations as (-1, -1)
+_CELL_DTYPE = np.dtype('<i2')
+_MISSING_LOCATION = (-1, -1)
+
+
+class PickPathJsonLinesWriter(object):
+    """
+    Streams pick paths to a JSON Lines file: a header line with the file format version, then one compact record per
+    pick path, written as soon as it is produced. The file is fsync-ed every fsync_every records. When resuming, the
+    paths already in the file are kept (a record cut short by a crash is dropped) and their IDs are available in
+    written_path_ids so they can be skipped.
+    """
+
+    def __init__(self, file_path, fsync_every=100, resume=False):
+        self.file_path = file_path
+        self.fsync_every = fsync_every
+        self.written_path_ids = set()
+        self._records_since_fsync = 0
+
+        if resume and os.path.exists(file_path):
+            self.written_path_ids, valid_length = _scan_json_lines_file(file_path)
+
+            self._file = open(file_path, mode='r+b')
+            self._file.truncate(valid_length)
+            self._file.seek(valid_length)
+
+            if valid_length == 0:
+                self._write_line({'version': PICK_PATH_FILE_FORMAT_VERSION})
+        else:
+            self._file = open(file_path, mode='wb')
+            self._write_line({'version': PICK_PATH_FILE_FORMAT_VERSION})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_line(self, obj):
+        self._file.write((json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8'))
+
+    def write(self, pick_path):
+        self._write_line(pick_path)
+        self.written_path_ids.add(pick_path['pathId'])
+
+        self._records_since_fsync += 1
+        if self._records_since_fsync >= self.fsync_every:
+            self.fsync()
+
+    def fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records_since_fsync = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self.fsync()
+        self._file.close()
+
+
+def _scan_json_lines_file(file_path):
+    """ Returns the path IDs in the given JSON Lines file and the length of its prefix of complete, valid lines. """
+
+    path_ids = set()
+    valid_length = 0
+
+    with open(file_path, mode='rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+
+            if 'version' in record:
+                assert record['version'] == PICK_PATH_FILE_FORMAT_VERSION
+            else:
+                path_ids.add(record['pathId'])
+
+            valid_length += len(line)
+
+    return path_ids, valid_length
+
+
+def iter_json_lines_pick_paths(file_path):
+    """ Yields the pick paths of the given JSON Lines file, in file order. """
+
+    with open(file_path, mode='rb') as f:
+        header = json.loads(f.readline().decode('utf-8'))
+        assert header['version'] == PICK_PATH_FILE_FORMAT_VERSION
+
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
+
+
+def export_json_lines_to_json(json_lines_file_path, json_file_path):
+    """
+    Exports a JSON Lines pick paths file to the version 1.2 JSON envelope read by visualize.py, with the pick paths in
+    pathId order. Pick paths are re-read from disk one at a time, so the whole data set is never held in memory.
+    """
+
+    with open(json_lines_file_path, mode='rb') as source:
+        # Index the records by path ID so they can be written out in order
+        offsets_by_path_id = {path_id: offset for path_id, offset, _ in _index_json_file(source)}
+
+        def iter_pick_paths_in_order():
+            for path_id in sorted(offsets_by_path_id):
+                source.seek(offsets_by_path_id[path_id])
+                yield json.loads(source.readline().decode('utf-8'))
+
+        _write_json(json_file_path, iter_pick_paths_in_order())
+
+
+def _write_json(json_file_path, pick_paths):
+    """ Writes the pick paths to the version 1.2 JSON envelope, one at a time, along with its sidecar index. """
+
+    entries = []
+
+    with open(json_file_path, mode='w') as f:
+        f.write('{\n    "version": %s,\n    "pickPaths": [' % json.dumps(PICK_PATH_FILE_FORMAT_VERSION))
+
+        for i, pick_path in enumerate(pick_paths):
+            pick_path_json = json.dumps(pick_path, indent=4).replace('\n', '\n        ')
+            f.write('%s\n        ' % (',' if i > 0 else ''))
+
+            entries.append((pick_path['pathId'], f.tell(), len(pick_path_json)))
+            f.write(pick_path_json)
+
+        f.write('\n    ]\n}\n')
+
+    _save_json_index(json_file_path, os.stat(json_file_path), entries)
+
+
+class PickPathJsonReader(object):
+    """
+    Reads pick paths one at a time from a version 1.2 JSON file or a JSON Lines file, like PickPathBinaryReader does
+    from binary files. The byte range of every pick path comes from the sidecar index next to the file, or from one
+    pass over its raw bytes when the index is missing or older than the file. With save_index, an index built that way
+    is saved for next time.
+    """
+
+    def __init__(self, file_path, save_index=False):
+        self.file_path = file_path
+        self._file = open(file_path, mode='rb')
+
+        entries = _load_json_index(file_path)
+        if entries is None:
+            # Taken first, so that an index of a file still being appended to is never mistaken for a complete one
+            file_stat = os.fstat(self._file.fileno())
+
+            entries = _index_json_file(self._file)
+            if save_index:
+                _save_json_index(file_path, file_stat, entries)
+
+        self._ranges_by_path_id = {path_id: (offset, length) for path_id, offset, length in entries}
+        self.path_ids = sorted(self._ranges_by_path_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def __contains__(self, path_id):
+        return path_id in self._ranges_by_path_id
+
+    def __iter__(self):
+        """ Yields the pick paths in pathId order. """
+
+        for path_id in self.path_ids:
+            yield self.get(path_id)
+
+    def get(self, path_id):
+        """ Returns the pick path with the given path ID, decoding only its own bytes. """
+
+        try:
+            offset, length = self._ranges_by_path_id[path_id]
+        except KeyError:
+            raise KeyError("No pick path %s in %s" % (path_id, self.file_path))
+
+        self._file.seek(offset)
+        return json.loads(self._file.read(length).decode('utf-8'))
+
+    def close(self):
+        self._file.close()
+
+
+def open_pick_path_file(file_path, save_index=False):
+    """
+    Returns the reader for a binary, JSON or JSON Lines pick path file, depending on its contents. save_index is passed
+    on to PickPathJsonReader.
+    """
+
+    with open(file_path, mode='rb') as f:
+        is_binary = f.read(len(PICK_PATH_BINARY_FILE_MAGIC)) == PICK_PATH_BINARY_FILE_MAGIC
+
+    return PickPathBinaryReader(file_path) if is_binary else PickPathJsonReader(file_path, save_index)
+
+
+def _load_json_index(file_path):
+    """ Returns the (path ID, offset, length) entries of the sidecar index of the file, or None if it is stale. """
+
+    index_file_path = file_path + PICK_PATH_INDEX_FILE_SUFFIX
+    if not os.path.exists(index_file_path):
+        return None
+
+    with open(index_file_path) as f:
+        index = json.load(f)
+
+    file_stat = os.stat(file_path)
+    if index.get('version') != PICK_PATH_FILE_FORMAT_VERSION or index['fileSize'] != file_stat.st_size \
+            or index['fileModificationTime'] != file_stat.st_mtime:
+        return None
+
+    return zip(index['pathIds'], index['offsets'], index['lengths'])
+
+
+def _save_json_index(file_path, file_stat, entries):
+    path_ids, offsets, lengths = zip(*entries) if entries else ((), (), ())
+
+    index = {
+        'version': PICK_PATH_FILE_FORMAT_VERSION,
+        'fileSize': file_stat.st_size,
+        'fileModificationTime': file_stat.st_mtime,
+        'pathIds': path_ids,
+        'offsets': offsets,
+        'lengths': lengths,
+    }
+
+    # The index is only a shortcut, readers can do without it in read-only directories
+    try:
+        with open(file_path + PICK_PATH_INDEX_FILE_SUFFIX, mode='w') as f:
+            json.dump(index, f, separators=(',', ':'))
+    except (IOError, OSError):
+        pass
+
+
+# The header line of JSON Lines files
+_JSON_LINES_HEADER = re.compile(br'^\s*\{\s*"version"\s*:\s*("[^"\\]*")\s*\}\s*$')
+
+# The tokens of a JSON document that matter when looking for the pick paths in it: strings, which may hold brackets,
+# and brackets. Numbers, literals, colons and commas are skipped over
+_JSON_TOKEN = re.compile(br'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+# The path ID of a pick path. A quoted "pathId" followed by a colon can only be a key, and no object nested in a pick
+# path has one
+_PATH_ID = re.compile(br'"pathId"\s*:\s*(-?\d+)')
+
+_STRING_VALUE = re.compile(br'\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def _index_json_file(f):
+    """
+    Returns the (path ID, offset, length) of every pick path in an open JSON or JSON Lines file. Only the bytes of the
+    file are scanned: strings and brackets locate the pick paths, and a pattern picks their path IDs out, so no pick
+    path is decoded.
+    """
+
+    f.seek(0)
+    first_line = f.readline()
+
+    entries = []
+
+    # JSON Lines files start with a header line of their own, a record cut short by a crash is left out
+    header = _JSON_LINES_HEADER.match(first_line)
+    if header is not None:
+        assert json.loads(header.group(1).decode('utf-8')) == PICK_PATH_FILE_FORMAT_VERSION
+
+        offset = len(first_line)
+        for line in iter(f.readline, b''):
+            if not line.endswith(b'\n'):
+                break
+
+            entries.append((int(_PATH_ID.search(line).group(1)), offset, len(line)))
+            offset += len(line)
+
+        return entries
+
+    # Walk the brackets of the JSON envelope: the pick paths are the objects right inside its "pickPaths" array
+    if os.fstat(f.fileno()).st_size == 0:
+        raise ValueError("%s is empty" % f.name)
+
+    text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        version = None
+        depth = 0
+        last_envelope_string = None
+        pick_paths_depth = None
+        pick_path_start = None
+
+        for token in _JSON_TOKEN.finditer(text):
+            character = token.group()[:1]
+
+            if character == b'"':
+                if depth == 1:
+                    last_envelope_string = token.group()
+
+                    if last_envelope_string == b'"version"':
+                        value = _STRING_VALUE.match(text, token.end())
+                        if value is not None:
+                            version = json.loads(value.group(1).decode('utf-8'))
+            elif character in b'[{':
+                if character == b'[' and depth == 1 and last_envelope_string == b'"pickPaths"':
+                    pick_paths_depth = depth + 1
+                elif character == b'{' and depth == pick_paths_depth:
+                    pick_path_start = token.start()
+
+                depth += 1
+            else:
+                depth -= 1
+
+                if depth == pick_paths_depth and pick_path_start is not None:
+                    pick_path = text[pick_path_start:token.end()]
+                    entries.append((int(_PATH_ID.search(pick_path).group(1)), pick_path_start, len(pick_path)))
+                    pick_path_start = None
+                elif pick_paths_depth is not None and depth < pick_paths_depth:
+                    pick_paths_depth = None
+    finally:
+        text.close()
+
+    assert version == PICK_PATH_FILE_FORMAT_VERSION
+
+    return entries
+
+
+class PickPathBinaryWriter(object):
+    """
+    Writes pick paths to the compact binary format, for data sets too large for JSON. Every record is length-prefixed
+    and stores the books of its pick path as indices into a catalog of the distinct books, and every location and cell
+    as a packed int16 (r, c) pair. The catalog and an index of the offset of every path ID are written after the
+    records when the writer is closed, so pick paths can be streamed in and later read back one at a time with
+    PickPathBinaryReader.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        self._books = []
+        self._book_indices = {}
+        self._path_types = []
+        self._offsets_by_path_id = {}
+
+        self._file = open(file_path, mode='wb')
+        self._file.write(_BINARY_FILE_HEADER.pack(PICK_PATH_BINARY_FILE_MAGIC, PICK_PATH_BINARY_FILE_FORMAT_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_book_index(self, book):
+        if book is None:
+            return -1
+
+        key = json.dumps(book, sort_keys=True)
+        if key not in self._book_indices:
+            self._book_indices[key] = len(self._books)
+            self._books.append(book)
+
+        return self._book_indices[key]
+
+    def write(self, pick_path):
+        path_id = pick_path['pathId']
+        if path_id in self._offsets_by_path_id:
+            raise ValueError("Pick path %s was already written" % path_id)
+
+        if pick_path['pathType'] not in self._path_types:
+            self._path_types.append(pick_path['pathType'])
+
+        pick_path_information = pick_path['pickPathInformation']
+        unordered_books_and_locations = pick_path_information['unorderedBooksAndLocations']
+        ordered_books_and_locations = pick_path_information['orderedBooksAndLocations']
+        ordered_pick_path = pick_path_information['orderedPickPath']
+
+        targets = [step['targetBookAndTargetBookLocation'] for step in ordered_pick_path]
+        paths = [step['cellByCellPathToTargetBookLocation'] for step in ordered_pick_path]
+
+        record = [
+            _BINARY_RECORD_HEADER.pack(path_id, self._path_types.index(pick_path['pathType']),
+                                       len(unordered_books_and_locations), len(ordered_books_and_locations),
+                                       len(ordered_pick_path)),
+            _pack_ints([self._get_book_index(entry['book']) for entry in unordered_books_and_locations], '<i4'),
+            _pack_cells([entry['location'] for entry in unordered_books_and_locations]),
+            _pack_ints([self._get_book_index(entry['book']) for entry in ordered_books_and_locations], '<i4'),
+            _pack_cells([entry['location'] for entry in ordered_books_and_locations]),
+            _pack_ints([step['stepNumber'] for step in ordered_pick_path], '<i4'),
+            _pack_ints([self._get_book_index(target['book']) for target in targets], '<i4'),
+            _pack_cells([
+                _MISSING_LOCATION if target['location'] is None else target['location'] for target in targets]),
+            _pack_ints([len(path) for path in paths], '<u4'),
+            _pack_cells([cell for path in paths for cell in path]),
+        ]
+
+        record = b''.join(record)
+
+        self._offsets_by_path_id[path_id] = self._file.tell()
+        self._file.write(_RECORD_LENGTH.pack(len(record)))
+        self._file.write(record)
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        catalog = {'version': PICK_PATH_FILE_FORMAT_VERSION, 'pathTypes': self._path_types, 'books': self._books}
+
+        catalog_offset = self._file.tell()
+        self._write_block(json.dumps(catalog, separators=(',', ':')).encode('utf-8'))
+
+        path_ids = sorted(self._offsets_by_path_id)
+
+        index_offset = self._file.tell()
+        self._write_block(_pack_ints(path_ids, '<i4') +
+                          _pack_ints([self._offsets_by_path_id[path_id] for path_id in path_ids], '<u8'))
+
+        self._file.write(_BINARY_FILE_FOOTER.pack(
+            catalog_offset, index_offset, len(path_ids), PICK_PATH_BINARY_FILE_MAGIC))
+        self._file.close()
+
+    def _write_block(self, block):
+        self._file.write(_RECORD_LENGTH.pack(len(block)))
+        self._file.write(block)
+
+
+class PickPathBinaryReader(object):
+    """
+    Reads pick paths back from a file made by PickPathBinaryWriter, as the same dictionaries as in version 1.2 JSON.
+    Only the footer, the catalog and the index are read when opening the file; get decodes a single pick path by
+    seeking to its record.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, mode='rb')
+
+        magic, version = _BINARY_FILE_HEADER.unpack(self._file.read(_BINARY_FILE_HEADER.size))
+        if magic != PICK_PATH_BINARY_FILE_MAGIC:
+            raise ValueError("%s is not a binary pick path file" % file_path)
+
+        assert version == PICK_PATH_BINARY_FILE_FORMAT_VERSION
+
+        self._file.seek(-_BINARY_FILE_FOOTER.size, os.SEEK_END)
+        catalog_offset, index_offset, number_of_pick_paths, magic = _BINARY_FILE_FOOTER.unpack(
+            self._file.read(_BINARY_FILE_FOOTER.size))
+
+        if magic != PICK_PATH_BINARY_FILE_MAGIC:
+            raise ValueError("%s was not closed properly" % file_path)
+
+        catalog = json.loads(self._read_block(catalog_offset).decode('utf-8'))
+        assert catalog['version'] == PICK_PATH_FILE_FORMAT_VERSION
+
+        self._books = catalog['books']
+        self._path_types = catalog['pathTypes']
+
+        index = self._read_block(index_offset)
+        self.path_ids = np.frombuffer(index, dtype='<i4', count=number_of_pick_paths).tolist()
+        self._offsets = np.frombuffer(index, dtype='<u8', offset=4 * number_of_pick_paths).tolist()
+        self._offsets_by_path_id = dict(zip(self.path_ids, self._offsets))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def __contains__(self, path_id):
+        return path_id in self._offsets_by_path_id
+
+    def __iter__(self):
+        """ Yields the pick paths in pathId order. """
+
+        for path_id in self.path_ids:
+            yield self.get(path_id)
+
+    def _read_block(self, offset):
+        self._file.seek(offset)
+        length, = _RECORD_LENGTH.unpack(self._file.read(_RECORD_LENGTH.size))
+        return self._file.read(length)
+
+    def _get_book(self, index):
+        return None if index == -1 else dict(self._books[index])
+
+    def get(self, path_id):
+        """ Returns the pick path with the given path ID, with the same structure as in version 1.2 JSON. """
+
+        try:
+            record = self._read_block(self._offsets_by_path_id[path_id])
+        except KeyError:
+            raise KeyError("No pick path %s in %s" % (path_id, self.file_path))
+
+        path_id, path_type_index, number_of_unordered_books, number_of_ordered_books, number_of_steps = \
+            _BINARY_RECORD_HEADER.unpack_from(record)
+
+        reader = _RecordReader(record, _BINARY_RECORD_HEADER.size)
+
+        unordered_book_indices = reader.read_ints(number_of_unordered_books, '<i4')
+        unordered_locations = reader.read_cells(number_of_unordered_books)
+        ordered_book_indices = reader.read_ints(number_of_ordered_books, '<i4')
+        ordered_locations = reader.read_cells(number_of_ordered_books)
+        step_numbers = reader.read_ints(number_of_steps, '<i4')
+        target_book_indices = reader.read_ints(number_of_steps, '<i4')
+        target_locations = reader.read_cells(number_of_steps)
+        path_lengths = reader.read_ints(number_of_steps, '<u4')
+        cells = reader.read_cells(sum(path_lengths))
+
+        ordered_pick_path = []
+        start = 0
+        for step_number, target_book_index, target_location, path_length in zip(
+                step_numbers, target_book_indices, target_locations, path_lengths):
+            ordered_pick_path.append({
+                'stepNumber': step_number,
+                'cellByCellPathToTargetBookLocation': cells[start:start + path_length],
+                'targetBookAndTargetBookLocation': {
+                    'book': self._get_book(target_book_index),
+                    'location': None if tuple(target_location) == _MISSING_LOCATION else target_location,
+                },
+            })
+            start += path_length
+
+        return {
+            'pathId': path_id,
+            'pathType': self._path_types[path_type_index],
+            'pickPathInformation': {
+                'unorderedBooksAndLocations': [
+                    {'book': self._get_book(index), 'location': location}
+                    for index, location in zip(unordered_book_indices, unordered_locations)
+                ],
+                'orderedBooksAndLocations': [
+                    {'book': self._get_book(index), 'location': location}
+                    for index, location in zip(ordered_book_indices, ordered_locations)
+                ],
+                'orderedPickPath': ordered_pick_path,
+            },
+        }
+
+    def close(self):
+        self._file.close()
+
+
+class _RecordReader(object):
+    """ Reads consecutive packed arrays out of a record. """
+
+    def __init__(self, record, offset):
+        self.record = record
+        self.offset = offset
+
+    def read_ints(self, count, dtype):
+        values = np.frombuffer(self.record, dtype=dtype, count=count, offset=self.offset)
+        self.offset += values.nbytes
+        return values.tolist()
+
+    def read_cells(self, count):
+        cells = np.frombuffer(self.record, dtype=_CELL_DTYPE, count=2 * count, offset=self.offset)
+        self.offset += cells.nbytes
+        return cells.reshape(count, 2).tolist()
+
+
+def _pack_ints(values, dtype):
+    return np.array(values, dtype=np.int64).astype(dtype).tobytes()
+
+
+def _pack_cells(cells):
+    cells = np.array(cells, dtype=np.int64).reshape(-1, 2)
+
+    if cells.size and (cells.min() < np.iinfo(_CELL_DTYPE).min or cells.max() > np.iinfo(_CELL_DTYPE).max):
+        raise ValueError("Cells must fit in int16 to be written to a binary pick path file")
+
+    return cells.astype(_CELL_DTYPE).tobytes()
+
+
+def export_json_lines_to_binary(json_lines_file_path, binary_file_path):
+    """ Exports a JSON Lines pick paths file to the binary format, one pick path at a time. """
+
+    with PickPathBinaryWriter(binary_file_path) as writer:
+        for pick_path in iter_json_lines_pick_paths(json_lines_file_path):
+            writer.write(pick_path)
+
+
+def export_json_to_binary(json_file_path, binary_file_path):
+    """ Exports a version 1.2 JSON pick paths file, e.g. an existing pick-paths.json, to the binary format. """
+
+    with open(json_file_path) as f:
+        pick_path_data = json.load(f)
+
+    assert pick_path_data['version'] == PICK_PATH_FILE_FORMAT_VERSION
+
+    with PickPathBinaryWriter(binary_file_path) as writer:
+        for pick_path in pick_path_data['pickPaths']:
+            writer.write(pick_path)
+
+
+def export_binary_to_json(binary_file_path, json_file_path):
+    """ Exports a binary pick paths file back to the version 1.2 JSON envelope, with the pick paths in pathId order. """
+
+    with PickPathBinaryReader(binary_file_path) as reader:
+        _write_json(json_file_path, reader)
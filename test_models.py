@@ -0,0 +1,172 @@
+import copy
+import json
+import os
+import unittest
+import numpy as np
+import utils
+from constants import NAVIGABLE_CELL, SHELVE_CELL
+
+WAREHOUSE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warehouse.json')
+
+
+def is_clear_shot_by_scanning(gt_library_warehouse, location_a, location_b, radius):
+    """ The original clear shot check: no non-navigable cell of the whole grid may be within radius of the segment. """
+
+    path_line = location_a, location_b
+
+    for r in range(gt_library_warehouse.num_rows):
+        for c in range(gt_library_warehouse.num_cols):
+            if gt_library_warehouse.get_cell(r, c) is not NAVIGABLE_CELL:
+                if utils.minimumDistance(path_line, (r, c)) <= radius:
+                    return False
+
+    return True
+
+
+class ClearShotTest(unittest.TestCase):
+    """ is_clear_shot must agree with scanning the whole grid, whatever shortcuts it takes. """
+
+    def setUp(self):
+        self.gt_library_warehouse = utils.get_warehouse(WAREHOUSE_FILE_PATH, use_cache=False)
+
+        walkable_cells = np.argwhere(np.isin(
+            self.gt_library_warehouse.navigation_grid_array, (NAVIGABLE_CELL, SHELVE_CELL)))
+        self.walkable_cells = [tuple(cell) for cell in walkable_cells.tolist()]
+
+    def get_random_cell_pairs(self, random_state, number_of_pairs):
+        """ Returns pairs of distinct walkable cells, half of them close together so that not every shot is blocked. """
+
+        walkable_cells = set(self.walkable_cells)
+        cell_pairs = []
+
+        while len(cell_pairs) < number_of_pairs:
+            location_a = self.walkable_cells[random_state.randint(len(self.walkable_cells))]
+
+            if len(cell_pairs) % 2 == 0:
+                location_b = self.walkable_cells[random_state.randint(len(self.walkable_cells))]
+            else:
+                offset_r, offset_c = random_state.randint(-6, 7, size=2)
+                location_b = (location_a[0] + int(offset_r), location_a[1] + int(offset_c))
+
+            if location_b != location_a and location_b in walkable_cells:
+                cell_pairs.append((location_a, location_b))
+
+        return cell_pairs
+
+    def test_against_scanning_the_grid(self):
+        random_state = np.random.RandomState(0)
+        cell_pairs = self.get_random_cell_pairs(random_state, 150)
+
+        number_of_clear_shots = 0
+
+        # Radii right at the distances between cell centres too, where rounding matters most
+        for radius in (0.3, 0.5, 1.0, np.sqrt(2), 1.6):
+            for location_a, location_b in cell_pairs:
+                expected = is_clear_shot_by_scanning(self.gt_library_warehouse, location_a, location_b, radius)
+
+                # Twice, the second time from the cache
+                for _ in range(2):
+                    self.assertEqual(
+                        self.gt_library_warehouse.is_clear_shot(location_a, location_b, radius), expected,
+                        "Shot from %s to %s with radius %s" % (location_a, location_b, radius))
+
+                number_of_clear_shots += expected
+
+        # Both outcomes must have been exercised
+        self.assertGreater(number_of_clear_shots, 0)
+        self.assertLess(number_of_clear_shots, 5 * len(cell_pairs))
+
+
+class LayoutUpdateTest(unittest.TestCase):
+    """ Repairing the derived structures after cells are flipped must give the same ones as building them afresh. """
+
+    DEPOT = (0, 0)
+
+    def setUp(self):
+        with open(WAREHOUSE_FILE_PATH) as f:
+            self.warehouse_data = json.load(f)
+
+        self.gt_library_warehouse = utils.get_warehouse_from_dict(self.warehouse_data)
+        self.gt_library_warehouse.precompute(depots=[self.DEPOT])
+
+    def get_fresh_warehouse(self):
+        """ Returns a warehouse built from scratch on the current layout of the repaired one. """
+
+        warehouse_data = copy.deepcopy(self.warehouse_data)
+        warehouse_data['warehouseLayout']['navigationGrid'] = self.gt_library_warehouse.navigation_grid
+
+        gt_library_warehouse = utils.get_warehouse_from_dict(warehouse_data)
+        gt_library_warehouse.precompute(depots=[self.DEPOT])
+
+        return gt_library_warehouse
+
+    def assert_matches_fresh_warehouse(self, step):
+        fresh_warehouse = self.get_fresh_warehouse()
+        message = "After step %d" % step
+
+        distance_oracle = self.gt_library_warehouse.get_distance_oracle()
+        fresh_distance_oracle = fresh_warehouse.get_distance_oracle()
+
+        self.assertEqual(distance_oracle.sources, fresh_distance_oracle.sources, message)
+        np.testing.assert_array_equal(distance_oracle.distances, fresh_distance_oracle.distances, message)
+        np.testing.assert_array_equal(distance_oracle.predecessors, fresh_distance_oracle.predecessors, message)
+
+        self.assertEqual(self.gt_library_warehouse.get_neighbor_lists(), fresh_warehouse.get_neighbor_lists(), message)
+        np.testing.assert_allclose(
+            self.gt_library_warehouse.get_clearance_map(), fresh_warehouse.get_clearance_map(), atol=1e-9,
+            err_msg=message)
+
+        # Every clear shot still cached must be what a fresh warehouse finds
+        clear_shot_cache = self.gt_library_warehouse.get_clear_shot_cache()
+        for location_a, location_b, radius in clear_shot_cache.keys():
+            self.assertEqual(
+                clear_shot_cache.get((location_a, location_b, radius)),
+                fresh_warehouse.is_clear_shot(location_a, location_b, radius),
+                "%s: shot from %s to %s with radius %s" % (message, location_a, location_b, radius))
+
+    def fill_clear_shot_cache(self, random_state):
+        walkable_cells = np.argwhere(np.isin(
+            self.gt_library_warehouse.navigation_grid_array, (NAVIGABLE_CELL, SHELVE_CELL)))
+
+        for _ in range(100):
+            location_a = tuple(walkable_cells[random_state.randint(len(walkable_cells))].tolist())
+            offset_r, offset_c = random_state.randint(-5, 6, size=2)
+            location_b = (location_a[0] + int(offset_r), location_a[1] + int(offset_c))
+
+            if 0 <= location_b[0] < self.gt_library_warehouse.num_rows and \
+                    0 <= location_b[1] < self.gt_library_warehouse.num_cols and \
+                    self.gt_library_warehouse.get_cell(*location_b) in (NAVIGABLE_CELL, SHELVE_CELL):
+                self.gt_library_warehouse.is_clear_shot(location_a, location_b, random_state.choice([0.5, 1.0]))
+
+    def test_random_block_and_unblock_sequences(self):
+        random_state = np.random.RandomState(0)
+
+        sources = set(self.gt_library_warehouse.get_distance_oracle().source_indices)
+        blocked_cells = []
+
+        for step in range(20):
+            self.fill_clear_shot_cache(random_state)
+
+            if not blocked_cells or random_state.rand() < 0.6:
+                navigable_cells = [
+                    cell for cell in map(tuple, np.argwhere(
+                        self.gt_library_warehouse.navigation_grid_array == NAVIGABLE_CELL).tolist())
+                    if cell not in sources
+                ]
+                cells = [navigable_cells[i] for i in random_state.choice(
+                    len(navigable_cells), size=random_state.randint(1, 4), replace=False)]
+
+                self.gt_library_warehouse.block_cells(cells)
+                blocked_cells.extend(cells)
+            else:
+                cells = [blocked_cells[i] for i in random_state.choice(
+                    len(blocked_cells), size=min(len(blocked_cells), random_state.randint(1, 3)), replace=False)]
+
+                self.gt_library_warehouse.unblock_cells(cells)
+                blocked_cells = [cell for cell in blocked_cells if cell not in cells]
+
+            self.assert_matches_fresh_warehouse(step)
+
+
+if __name__ == '__main__':
+    unittest.main()
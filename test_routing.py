@@ -0,0 +1,87 @@
+import os
+import unittest
+import numpy as np
+import utils
+from constants import NAVIGABLE_CELL
+
+WAREHOUSE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warehouse.json')
+
+
+class AisleGraphTest(unittest.TestCase):
+    """ Routes on the aisle-level graph must be as short as the shortest paths of the distance oracle. """
+
+    DEPOT = (0, 0)
+
+    def setUp(self):
+        self.gt_library_warehouse = utils.get_warehouse(WAREHOUSE_FILE_PATH, use_cache=False)
+        self.gt_library_warehouse.precompute(depots=[self.DEPOT])
+
+    def assert_path_is_proper(self, path, cell_a, cell_b, distance):
+        self.assertEqual(path[0], cell_a)
+        self.assertEqual(path[-1], cell_b)
+        self.assertEqual(len(path) - 1, distance)
+
+        for (r, c), (next_r, next_c) in zip(path[:-1], path[1:]):
+            self.assertEqual(abs(next_r - r) + abs(next_c - c), 1)
+            self.assertIs(self.gt_library_warehouse.get_cell(next_r, next_c), NAVIGABLE_CELL)
+
+    def assert_matches_distance_oracle(self):
+        aisle_graph = self.gt_library_warehouse.get_aisle_graph(depots=[self.DEPOT])
+        distance_oracle = self.gt_library_warehouse.get_distance_oracle()
+
+        # Far fewer nodes than cells
+        num_cells = self.gt_library_warehouse.num_rows * self.gt_library_warehouse.num_cols
+        self.assertLess(10 * len(aisle_graph.nodes), num_cells)
+
+        for i, cell_a in enumerate(aisle_graph.nodes):
+            distances, _ = distance_oracle.get_shortest_path_tree(cell_a)
+
+            for j, cell_b in enumerate(aisle_graph.nodes):
+                expected = distances[distance_oracle.get_cell_index(cell_b)]
+
+                if expected == distance_oracle.UNREACHABLE:
+                    self.assertRaises(ValueError, aisle_graph.get_distance, cell_a, cell_b)
+                    continue
+
+                self.assertEqual(aisle_graph.get_distance(cell_a, cell_b), expected)
+
+                # Expanding every pair would be slow, the ones from the depot and a few others are enough
+                if cell_a == self.DEPOT or (i + j) % 7 == 0:
+                    self.assert_path_is_proper(aisle_graph.get_path(cell_a, cell_b), cell_a, cell_b, expected)
+
+    def test_against_distance_oracle(self):
+        aisle_graph = self.gt_library_warehouse.get_aisle_graph(depots=[self.DEPOT])
+
+        # Every aisle has a junction at both ends of its corridor
+        self.assertEqual(len(aisle_graph.nodes), len(self.gt_library_warehouse.get_distance_oracle().sources) + 16)
+
+        self.assert_matches_distance_oracle()
+
+    def test_after_blocking_cells(self):
+        random_state = np.random.RandomState(0)
+
+        aisle_graph = self.gt_library_warehouse.get_aisle_graph(depots=[self.DEPOT])
+        sources = self.gt_library_warehouse.get_distance_oracle().source_indices
+
+        # Some junctions, and cells at random
+        junctions = [node for node in aisle_graph.nodes if node not in sources]
+        navigable_cells = [
+            cell for cell in map(tuple, np.argwhere(
+                self.gt_library_warehouse.navigation_grid_array == NAVIGABLE_CELL).tolist())
+            if cell not in sources
+        ]
+
+        self.gt_library_warehouse.block_cells(junctions[:3] + [
+            navigable_cells[i] for i in random_state.choice(len(navigable_cells), size=40, replace=False)])
+
+        self.assertNotIn(junctions[0], self.gt_library_warehouse.get_aisle_graph(depots=[self.DEPOT]))
+        self.assert_matches_distance_oracle()
+
+    def test_cells_that_are_not_nodes(self):
+        aisle_graph = self.gt_library_warehouse.get_aisle_graph(depots=[self.DEPOT])
+
+        self.assertRaises(ValueError, aisle_graph.get_path, self.DEPOT, (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import storage
+
+PICK_PATHS_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pick-paths.json')
+
+
+def get_pick_path(path_id):
+    """ Returns a small pick path whose book titles hold the characters the indexing has to step over. """
+
+    book = {
+        'title': u'Brackets ]}[{, quotes \\" and a "pathId": %d \u00e9' % (path_id + 1000),
+        'author': u'Author %d' % path_id,
+        'aisle': 'A',
+        'column': str(path_id),
+        'row': 'B',
+    }
+    location = [path_id % 7, 3]
+
+    return {
+        'pathId': path_id,
+        'pathType': 'training' if path_id % 3 else 'testing',
+        'pickPathInformation': {
+            'unorderedBooksAndLocations': [{'book': book, 'location': location}],
+            'orderedBooksAndLocations': [{'book': book, 'location': location}],
+            'orderedPickPath': [
+                {
+                    'stepNumber': 1,
+                    'cellByCellPathToTargetBookLocation': [[0, 0], [0, 1], location],
+                    'targetBookAndTargetBookLocation': {'book': book, 'location': location},
+                },
+                {
+                    'stepNumber': 2,
+                    'cellByCellPathToTargetBookLocation': [location, [0, 1], [0, 0]],
+                    'targetBookAndTargetBookLocation': {'book': None, 'location': None},
+                },
+            ],
+        },
+    }
+
+
+class PickPathJsonReaderTest(unittest.TestCase):
+    """ The indexed JSON readers must return the same pick paths as decoding the whole file. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.json_lines_file_path = os.path.join(self.directory, 'pick-paths.jsonl')
+        self.json_file_path = os.path.join(self.directory, 'pick-paths.json')
+
+        # Written out of pathId order, as several workers would
+        self.pick_paths = {path_id: get_pick_path(path_id) for path_id in (3, 1, 12, 2, 7)}
+
+        with storage.PickPathJsonLinesWriter(self.json_lines_file_path) as writer:
+            for path_id in (3, 1, 12, 2, 7):
+                writer.write(self.pick_paths[path_id])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_reads_pick_paths(self, file_path, **kwargs):
+        with storage.open_pick_path_file(file_path, **kwargs) as reader:
+            self.assertIsInstance(reader, storage.PickPathJsonReader)
+            self.assertEqual(reader.path_ids, sorted(self.pick_paths))
+            self.assertEqual(len(reader), len(self.pick_paths))
+
+            # Random access, in an order of its own
+            for path_id in (7, 1, 12, 3, 2, 12):
+                self.assertEqual(reader.get(path_id), self.pick_paths[path_id])
+
+            self.assertEqual(list(reader), [self.pick_paths[path_id] for path_id in sorted(self.pick_paths)])
+            self.assertNotIn(5, reader)
+            self.assertRaises(KeyError, reader.get, 5)
+
+    def test_json_lines(self):
+        self.assert_reads_pick_paths(self.json_lines_file_path)
+
+    def test_json_lines_with_truncated_record(self):
+        with open(self.json_lines_file_path, mode='ab') as f:
+            f.write(json.dumps(get_pick_path(20))[:40].encode('utf-8'))
+
+        self.assert_reads_pick_paths(self.json_lines_file_path)
+
+    def test_exported_json(self):
+        storage.export_json_lines_to_json(self.json_lines_file_path, self.json_file_path)
+
+        # The export writes its own index, which must agree with indexing the file's bytes
+        with open(self.json_file_path, mode='rb') as f:
+            self.assertEqual(sorted(storage._load_json_index(self.json_file_path)),
+                             sorted(storage._index_json_file(f)))
+
+        self.assert_reads_pick_paths(self.json_file_path)
+
+        os.remove(self.json_file_path + storage.PICK_PATH_INDEX_FILE_SUFFIX)
+        self.assert_reads_pick_paths(self.json_file_path)
+
+    def test_json_on_a_single_line(self):
+        # Keys out of the usual order too
+        pick_path_data = {
+            'pickPaths': [self.pick_paths[path_id] for path_id in (12, 1, 7, 2, 3)],
+            'version': storage.PICK_PATH_FILE_FORMAT_VERSION,
+        }
+
+        with open(self.json_file_path, mode='w') as f:
+            json.dump(pick_path_data, f, separators=(',', ':'))
+
+        self.assert_reads_pick_paths(self.json_file_path)
+
+    def test_index_is_only_saved_when_asked_for(self):
+        index_file_path = self.json_lines_file_path + storage.PICK_PATH_INDEX_FILE_SUFFIX
+
+        self.assert_reads_pick_paths(self.json_lines_file_path)
+        self.assertFalse(os.path.exists(index_file_path))
+
+        self.assert_reads_pick_paths(self.json_lines_file_path, save_index=True)
+        self.assertTrue(os.path.exists(index_file_path))
+        self.assert_reads_pick_paths(self.json_lines_file_path)
+
+    def test_stale_index_is_rebuilt(self):
+        storage.PickPathJsonReader(self.json_lines_file_path, save_index=True).close()
+
+        self.pick_paths[20] = get_pick_path(20)
+        with storage.PickPathJsonLinesWriter(self.json_lines_file_path, resume=True) as writer:
+            writer.write(self.pick_paths[20])
+
+        with storage.PickPathJsonReader(self.json_lines_file_path) as reader:
+            self.assertIn(20, reader)
+            self.assertEqual(reader.get(20), self.pick_paths[20])
+
+
+class PickPathBinaryTest(unittest.TestCase):
+    """ Pick paths written to the binary format must read back exactly as they were written. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.binary_file_path = os.path.join(self.directory, 'pick-paths.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_round_trips(self, pick_paths):
+        pick_paths_by_path_id = {pick_path['pathId']: pick_path for pick_path in pick_paths}
+
+        with storage.open_pick_path_file(self.binary_file_path) as reader:
+            self.assertIsInstance(reader, storage.PickPathBinaryReader)
+            self.assertEqual(reader.path_ids, sorted(pick_paths_by_path_id))
+
+            # Random access, in an order of its own
+            for path_id in reversed(reader.path_ids[::3] + reader.path_ids[1::3] + reader.path_ids[2::3]):
+                self.assertEqual(reader.get(path_id), pick_paths_by_path_id[path_id])
+
+            self.assertEqual(list(reader), [pick_paths_by_path_id[path_id] for path_id in reader.path_ids])
+            self.assertRaises(KeyError, reader.get, max(reader.path_ids) + 1)
+
+    def test_pick_paths_json(self):
+        storage.export_json_to_binary(PICK_PATHS_FILE_PATH, self.binary_file_path)
+
+        with open(PICK_PATHS_FILE_PATH) as f:
+            self.assert_round_trips(json.load(f)['pickPaths'])
+
+    def test_written_pick_paths(self):
+        pick_paths = [get_pick_path(path_id) for path_id in (3, 1, 12, 2, 7)]
+
+        with storage.PickPathBinaryWriter(self.binary_file_path) as writer:
+            for pick_path in pick_paths:
+                writer.write(pick_path)
+
+            self.assertRaises(ValueError, writer.write, pick_paths[0])
+
+        self.assert_round_trips(pick_paths)
+
+    def test_back_to_json(self):
+        json_file_path = os.path.join(self.directory, 'pick-paths.json')
+
+        storage.export_json_to_binary(PICK_PATHS_FILE_PATH, self.binary_file_path)
+        storage.export_binary_to_json(self.binary_file_path, json_file_path)
+
+        with open(PICK_PATHS_FILE_PATH) as original, open(json_file_path) as exported:
+            self.assertEqual(json.load(exported), json.load(original))
+
+
+if __name__ == '__main__':
+    unittest.main()
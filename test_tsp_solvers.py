@@ -0,0 +1,122 @@
+import itertools
+import unittest
+import numpy as np
+import tsp_solvers
+
+
+def get_random_distance_matrices(random_state, n, symmetric, integer):
+    """ Yields a few random (n, n) distance matrices with zero diagonals. """
+
+    for _ in range(5):
+        if integer:
+            distance_matrix = random_state.randint(0, 100, size=(n, n))
+        else:
+            distance_matrix = random_state.uniform(0.0, 100.0, size=(n, n))
+
+        if symmetric:
+            distance_matrix = np.triu(distance_matrix, 1)
+            distance_matrix = distance_matrix + distance_matrix.T
+
+        np.fill_diagonal(distance_matrix, 0)
+
+        yield distance_matrix
+
+
+def solve_by_brute_force(distance_matrix, source):
+    """ Returns the cost of the optimal tour, trying every order of the nodes besides the source. """
+
+    others = [node for node in range(len(distance_matrix)) if node != source]
+
+    return min(tsp_solvers.get_tour_cost(distance_matrix, (source,) + permutation + (source,))
+               for permutation in itertools.permutations(others))
+
+
+class HeldKarpTest(unittest.TestCase):
+    """ Held-Karp must find tours as short as the shortest of all the tours. """
+
+    def assert_tour_is_optimal(self, distance_matrix, source, tour, cost):
+        n = len(distance_matrix)
+
+        self.assertEqual(tour[0], source)
+        self.assertEqual(tour[-1], source)
+        self.assertEqual(sorted(tour[:-1]), list(range(n)) if n > 1 else [source])
+
+        self.assertAlmostEqual(cost, tsp_solvers.get_tour_cost(distance_matrix, tour))
+        self.assertAlmostEqual(cost, solve_by_brute_force(distance_matrix, source))
+
+    def test_against_brute_force(self):
+        random_state = np.random.RandomState(0)
+
+        for n, symmetric, integer in itertools.product(range(2, 9), (True, False), (True, False)):
+            for distance_matrix in get_random_distance_matrices(random_state, n, symmetric, integer):
+                source = random_state.randint(n)
+
+                tour, cost = tsp_solvers.solve_held_karp(distance_matrix, source)
+
+                self.assert_tour_is_optimal(distance_matrix, source, tour, cost)
+
+    def test_single_node(self):
+        tour, cost = tsp_solvers.solve_held_karp(np.zeros((1, 1), dtype=np.int64))
+
+        self.assertEqual(tour, (0, 0))
+        self.assertEqual(cost, 0)
+
+    def test_costs_are_python_numbers(self):
+        _, cost = tsp_solvers.solve_held_karp(np.array([[0, 3], [4, 0]]))
+        self.assertIs(type(cost), int)
+        self.assertEqual(cost, 7)
+
+        _, cost = tsp_solvers.solve_held_karp(np.array([[0.0, 3.5], [4.0, 0.0]]))
+        self.assertIs(type(cost), float)
+        self.assertEqual(cost, 7.5)
+
+
+class HeldKarpBatchTest(unittest.TestCase):
+    """ Solving orders in batches must give the same tours and costs as solving them one at a time. """
+
+    def assert_batch_matches_single_orders(self, distance_matrices, source, memory_budget):
+        tours, costs = tsp_solvers.solve_held_karp_batch(distance_matrices, source, memory_budget)
+
+        self.assertEqual(len(tours), len(distance_matrices))
+        self.assertEqual(len(costs), len(distance_matrices))
+
+        for distance_matrix, tour, cost in zip(distance_matrices, tours, costs):
+            self.assertEqual((tour, cost), tsp_solvers.solve_held_karp(distance_matrix, source))
+
+    def test_against_single_orders(self):
+        random_state = np.random.RandomState(0)
+
+        for n, symmetric, integer in itertools.product((1, 2, 3, 6, 8), (True, False), (True, False)):
+            distance_matrices = np.array(list(get_random_distance_matrices(random_state, n, symmetric, integer)))
+            source = random_state.randint(n)
+
+            self.assert_batch_matches_single_orders(distance_matrices, source, tsp_solvers.HELD_KARP_MEMORY_BUDGET)
+
+    def test_in_several_chunks(self):
+        random_state = np.random.RandomState(1)
+
+        # Int32 DP tables of 5 nodes besides the source take 2 * (4 + 1) * 5 * 2^5 = 1600 bytes per order, float64
+        # ones 2 * (8 + 1) * 5 * 2^5 = 2880. The budgets give chunks of one order, of a few, and one chunk for all
+        for integer in (True, False):
+            distance_matrices = np.array([
+                distance_matrix for _ in range(3)
+                for distance_matrix in get_random_distance_matrices(random_state, 6, False, integer)])
+
+            for memory_budget in (1, 5000, 10 ** 6):
+                self.assert_batch_matches_single_orders(distance_matrices, 0, memory_budget)
+
+    def test_integer_and_fractional_distances_agree(self):
+        random_state = np.random.RandomState(2)
+
+        distance_matrices = np.array(list(get_random_distance_matrices(random_state, 7, False, True)))
+
+        integer_tours, integer_costs = tsp_solvers.solve_held_karp_batch(distance_matrices.astype(np.int64))
+        float_tours, float_costs = tsp_solvers.solve_held_karp_batch(distance_matrices.astype(np.float64))
+
+        self.assertEqual(integer_costs, float_costs)
+        for distance_matrix, tour, cost in zip(distance_matrices, float_tours, float_costs):
+            self.assertEqual(tsp_solvers.get_tour_cost(distance_matrix, tour), cost)
+
+
+if __name__ == '__main__':
+    unittest.main()
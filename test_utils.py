@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import utils
+
+
+class BatchedGeometryTest(unittest.TestCase):
+    """ The batched geometry helpers must agree with the scalar versions they replace. """
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+
+        integer_lines = random_state.randint(-20, 20, size=(50, 2, 2))
+        fractional_lines = random_state.uniform(-20.0, 20.0, size=(50, 2, 2))
+
+        # Segments whose two ends are the same point
+        degenerate_lines = np.repeat(random_state.randint(-20, 20, size=(10, 1, 2)), 2, axis=1)
+
+        self.lines = np.concatenate([integer_lines, fractional_lines, degenerate_lines])
+        self.points = np.concatenate([
+            random_state.randint(-20, 20, size=(30, 2)),
+            random_state.uniform(-20.0, 20.0, size=(30, 2)),
+            # Points right on segment ends
+            self.lines[:5, 0],
+            self.lines[-5:, 1],
+        ])
+
+    def test_distances(self):
+        points_a, points_b = self.lines[:, 0], self.lines[:, 1]
+
+        expected = [utils.distance(point_a, point_b) for point_a, point_b in zip(points_a, points_b)]
+
+        np.testing.assert_allclose(utils.distances(points_a, points_b), expected)
+        self.assertAlmostEqual(utils.distances(points_a[0], points_b[0]), expected[0])
+
+    def test_dot_products(self):
+        points_a, points_b = self.lines[:, 0], self.lines[:, 1]
+
+        expected = [utils.dotProduct(point_a, point_b) for point_a, point_b in zip(points_a, points_b)]
+
+        np.testing.assert_allclose(utils.dotProducts(points_a, points_b), expected)
+        self.assertAlmostEqual(utils.dotProducts(points_a[0], points_b[0]), expected[0])
+
+    def test_minimum_distances(self):
+        expected = [[utils.minimumDistance(line, point) for point in self.points] for line in self.lines]
+
+        actual = utils.minimumDistances(self.lines, self.points)
+
+        self.assertEqual(actual.shape, (len(self.lines), len(self.points)))
+        np.testing.assert_allclose(actual, expected, atol=1e-9)
+
+    def test_minimum_distances_of_single_segment(self):
+        for line in [self.lines[0], self.lines[60], self.lines[-1]]:
+            expected = [utils.minimumDistance(line, point) for point in self.points]
+
+            actual = utils.minimumDistances(line, self.points)
+
+            self.assertEqual(actual.shape, (len(self.points),))
+            np.testing.assert_allclose(actual, expected, atol=1e-9)
+
+    def test_minimum_distances_of_lists(self):
+        line = [[0, 0], [4, 0]]
+        points = [[2, 3], [-3, 4], [7, -4], [1, 0]]
+
+        np.testing.assert_allclose(utils.minimumDistances(line, points), [3.0, 5.0, 5.0, 0.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,489 @@
+import json
+import sqlite3
+import numpy as np
+import time
+import utils
+
+# Largest number of nodes, including the source, solve_held_karp accepts (about 100 MB of DP tables)
+HELD_KARP_MAX_NODES = 21
+
+# Bytes of DP tables solve_held_karp_batch allocates at once, by default
+HELD_KARP_MEMORY_BUDGET = 2 ** 28
+
+# Largest number of locations, not counting the source, solve_tsp solves exactly by default
+MAX_EXACT_TSP_LOCATIONS = 16
+
+# Seconds solve_tsp spends improving tours of orders that are too large to solve exactly, by default
+HEURISTIC_TSP_TIME_BUDGET = 1.0
+
+# Number of tours a TSPCache keeps in memory, by default
+TSP_CACHE_SIZE = 2 ** 14
+
+
+class TSPCache(object):
+    """
+    Bounded LRU cache of TSP tours, keyed by the depot and the set of locations an order visits, so that orders on the
+    same shelves aren't solved again. Tours are stored as sequences of locations, not of distance matrix indices. With a
+    file path, exact tours are also persisted to (and looked up in) a SQLite database, which outlives the process and is
+    shared by concurrent processes. Heuristic tours depend on the time budget they were improved within, so they are
+    only kept in memory. The namespace tells apart the tours of different warehouse layouts in that file.
+    """
+
+    def __init__(self, max_size=TSP_CACHE_SIZE, file_path=None, namespace=''):
+        self.namespace = namespace
+        self.persistent_hits = 0
+
+        self._entries = utils.LRUCache(max_size)
+        self._connection = None
+
+        if file_path is not None:
+            self._connection = sqlite3.connect(file_path, timeout=30)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS tours (namespace TEXT, key TEXT, tour TEXT, cost REAL, lower_bound REAL, '
+                'PRIMARY KEY (namespace, key))')
+            self._connection.commit()
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses - self.persistent_hits
+
+    @staticmethod
+    def get_key(source, locations):
+        """ Returns the canonical key of an order: its depot and its sorted distinct locations, other than the depot. """
+
+        source = tuple(source)
+        return source, tuple(sorted(set(tuple(location) for location in locations) - {source}))
+
+    def get(self, source, locations, max_exact_locations=MAX_EXACT_TSP_LOCATIONS):
+        """
+        Returns the cached (tour, cost, lower bound) of the order on the given locations, the tour being a tuple of
+        locations starting and ending at the source, or None. Heuristic tours are ignored when solve_tsp would now
+        solve the order exactly.
+        """
+
+        key = self.get_key(source, locations)
+
+        result = self._entries.get(key)
+        if result is None and self._connection is not None:
+            result = self._get_persisted(key)
+
+            if result is not None:
+                self.persistent_hits += 1
+                self._entries.put(key, result)
+
+        if result is None:
+            return None
+
+        tour, cost, lower_bound = result
+        if cost > lower_bound and len(key[1]) <= max_exact_locations:
+            return None
+
+        return result
+
+    def put(self, source, locations, tour, cost, lower_bound):
+        key = self.get_key(source, locations)
+        result = tuple(tuple(location) for location in tour), cost, lower_bound
+
+        self._entries.put(key, result)
+
+        if self._connection is not None and cost <= lower_bound:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO tours VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, json.dumps(key), json.dumps(result[0]), cost, lower_bound))
+            self._connection.commit()
+
+    def _get_persisted(self, key):
+        row = self._connection.execute(
+            'SELECT tour, cost, lower_bound FROM tours WHERE namespace = ? AND key = ?',
+            (self.namespace, json.dumps(key))).fetchone()
+
+        if row is None:
+            return None
+
+        tour, cost, lower_bound = row
+        return tuple(tuple(location) for location in json.loads(tour)), _to_python_number(cost), \
+            _to_python_number(lower_bound)
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'persistentHits': self.persistent_hits,
+            'misses': self.misses,
+        }
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def solve_tsp(distance_matrix, source=0, max_exact_locations=MAX_EXACT_TSP_LOCATIONS,
+              time_budget=HEURISTIC_TSP_TIME_BUDGET):
+    # type: (np.ndarray, int, int, float) -> (tuple, int, float)
+    """
+    Produces a TSP tour over a dense distance matrix, exactly with Held-Karp when there are at most max_exact_locations
+    nodes besides the source, and with the anytime heuristic solver otherwise.
+    :return: A tuple of node indices to visit, starting and ending at the source, the cost of that tour and a lower
+             bound on the cost of the optimal tour (the cost itself if the tour is optimal).
+    """
+
+    n = np.shape(distance_matrix)[0]
+
+    if n - 1 <= max_exact_locations:
+        tour, cost = solve_held_karp(distance_matrix, source)
+        return tour, cost, cost
+
+    return solve_heuristic(distance_matrix, source, time_budget=time_budget)
+
+
+def solve_held_karp(distance_matrix, source=0):  # type: (np.ndarray, int) -> (tuple, int)
+    """
+    Produces the optimal TSP tour over a dense distance matrix using the Held-Karp dynamic program over subset
+    bitmasks - O(n^2 * 2^n) time and O(n * 2^n) int32 memory (float64 for fractional distances). Each layer of subsets
+    is relaxed with vectorized NumPy min-reductions.
+    :param distance_matrix: An (n, n) matrix of non-negative distances between the nodes.
+    :param source: The index of the node the tour starts and ends at.
+    :return: A tuple of node indices to visit, starting and ending at the source, and the cost of that tour.
+    """
+
+    distance_matrix = np.asarray(distance_matrix)
+
+    tours, costs = solve_held_karp_batch(distance_matrix[np.newaxis], source)
+
+    return tours[0], costs[0]
+
+
+def solve_held_karp_batch(distance_matrices, source=0, memory_budget=HELD_KARP_MEMORY_BUDGET):
+    # type: (np.ndarray, int, int) -> (list, list)
+    """
+    Solves many same-size TSPs at once with Held-Karp, running each step of the dynamic program on all of them together
+    so the per-step NumPy overhead is shared. The orders are solved in chunks whose DP tables fit in memory_budget
+    bytes. Gives the same tours as solve_held_karp.
+    :param distance_matrices: A (B, n, n) stack of matrices of non-negative distances between the nodes, integer or
+                              not.
+    :param source: The index of the node every tour starts and ends at.
+    :return: The list of the B optimal tours, as tuples of node indices starting and ending at the source, and the list
+             of their costs.
+    """
+
+    distance_matrices = np.asarray(distance_matrices)
+
+    number_of_orders, n = distance_matrices.shape[:2]
+    assert distance_matrices.shape == (number_of_orders, n, n)
+    assert 0 <= source < n
+    assert n <= HELD_KARP_MAX_NODES, "Held-Karp is limited to %d nodes, got %d." % (HELD_KARP_MAX_NODES, n)
+
+    # Every other node is a bit in the subset masks
+    others = [node for node in range(n) if node != source]
+    m = len(others)
+
+    if m == 0:
+        return [(source, source)] * number_of_orders, [0] * number_of_orders
+
+    # The DP tables take a cost and a parent byte per (subset, node) pair, and relaxing one layer takes about as much
+    # again
+    cost_dtype = np.int32 if np.issubdtype(distance_matrices.dtype, np.integer) else np.float64
+    chunk_size = max(1, memory_budget // (2 * (np.dtype(cost_dtype).itemsize + 1) * m << m))
+
+    tours, costs = [], []
+    for start in range(0, number_of_orders, chunk_size):
+        chunk_tours, chunk_costs = _solve_held_karp_chunk(
+            distance_matrices[start:start + chunk_size], source, others, cost_dtype)
+        tours.extend(chunk_tours)
+        costs.extend(chunk_costs)
+
+    return tours, costs
+
+
+def _solve_held_karp_chunk(distance_matrices, source, others, cost_dtype=np.int32):
+    number_of_orders = distance_matrices.shape[0]
+    m = len(others)
+    orders = np.arange(number_of_orders)
+
+    if cost_dtype == np.int32:
+        infinity = np.iinfo(np.int32).max // 2
+        assert distance_matrices.max() < infinity // 2, "Distances are too large for the int32 DP table."
+    else:
+        infinity = np.inf
+
+    from_source = distance_matrices[:, source, others].astype(cost_dtype)
+    to_source = distance_matrices[:, others, source].astype(cost_dtype)
+    between_others = distance_matrices[:, others][:, :, others].astype(cost_dtype)
+
+    # min_cost[b, mask, j] is the cost, in order b, of leaving the source, visiting the nodes in mask and ending at node
+    # j (in mask)
+    min_cost = np.full((number_of_orders, 1 << m, m), infinity, dtype=cost_dtype)
+    parent = np.zeros((number_of_orders, 1 << m, m), dtype=np.int8)
+
+    masks = np.arange(1 << m)
+    subset_sizes = np.zeros(1 << m, dtype=np.int8)
+    for j in range(m):
+        subset_sizes += (masks >> j) & 1
+
+    for j in range(m):
+        min_cost[:, 1 << j, j] = from_source[:, j]
+
+    for subset_size in range(2, m + 1):
+        subsets = masks[subset_sizes == subset_size]
+
+        for j in range(m):
+            subsets_ending_at_j = subsets[(subsets >> j) & 1 == 1]
+            previous_subsets = subsets_ending_at_j ^ (1 << j)
+
+            # Nodes that aren't in the previous subset have an infinite cost, so they never win
+            costs = min_cost[:, previous_subsets] + between_others[:, np.newaxis, :, j]
+            previous_nodes = np.argmin(costs, axis=2)
+
+            min_cost[:, subsets_ending_at_j, j] = costs.min(axis=2)
+            parent[:, subsets_ending_at_j, j] = previous_nodes
+
+    all_nodes = (1 << m) - 1
+    tour_costs = min_cost[:, all_nodes] + to_source
+    last_nodes = np.argmin(tour_costs, axis=1)
+
+    tours = []
+    for b in orders:
+        # Walk the parents back from the last node visited
+        reversed_tour = []
+        mask, j = all_nodes, int(last_nodes[b])
+        while mask:
+            reversed_tour.append(others[j])
+            mask, j = mask ^ (1 << j), int(parent[b, mask, j])
+
+        tours.append((source,) + tuple(reversed_tour[::-1]) + (source,))
+
+    return tours, [_to_python_number(cost) for cost in tour_costs[orders, last_nodes]]
+
+
+def solve_heuristic(distance_matrix, source=0, time_budget=1.0, number_of_perturbations=50, seed=0):
+    # type: (np.ndarray, int, float, int, int) -> (tuple, int, float)
+    """
+    Produces a good TSP tour for orders too large for Held-Karp. Starts from the nearest-neighbour tour and improves it
+    with 2-opt and Or-opt moves until it is locally optimal, then keeps perturbing it with random double-bridge moves
+    and improving it again, until number_of_perturbations is reached or the time budget (in seconds) runs out. The
+    result is deterministic unless the time budget runs out.
+    :param distance_matrix: An (n, n) symmetric matrix of non-negative distances between the nodes.
+    :param source: The index of the node the tour starts and ends at.
+    :return: A tuple of node indices to visit, starting and ending at the source, the cost of that tour and a lower
+             bound on the cost of the optimal tour.
+    """
+
+    distance_matrix = np.asarray(distance_matrix)
+
+    n = distance_matrix.shape[0]
+    assert distance_matrix.shape == (n, n)
+    assert 0 <= source < n
+    assert np.array_equal(distance_matrix, distance_matrix.T), "The heuristic solver needs symmetric distances."
+
+    deadline = time.time() + time_budget
+
+    tour = _get_nearest_neighbor_tour(distance_matrix, source)
+    tour = _improve_tour(distance_matrix, tour, deadline)
+    cost = _get_tour_cost(distance_matrix, tour)
+
+    random_state = np.random.RandomState(seed)
+    for _ in range(number_of_perturbations):
+        if n < 8 or time.time() > deadline:
+            break
+
+        candidate_tour = _improve_tour(distance_matrix, _perturb_tour(tour, random_state), deadline)
+        candidate_cost = _get_tour_cost(distance_matrix, candidate_tour)
+
+        if candidate_cost < cost:
+            tour, cost = candidate_tour, candidate_cost
+
+    return tuple(int(node) for node in tour), _to_python_number(cost), get_one_tree_lower_bound(distance_matrix, source)
+
+
+def insert_cheapest(distance_matrix, tour, nodes):
+    """
+    Inserts each of the nodes, in turn, between the two consecutive nodes of the tour where it adds the least cost.
+    Returns the new tour, which starts and ends where the given one does.
+    """
+
+    distance_matrix = np.asarray(distance_matrix)
+    tour = list(tour)
+
+    for node in nodes:
+        x, y = np.array(tour[:-1]), np.array(tour[1:])
+        insertion_costs = distance_matrix[x, node] + distance_matrix[node, y] - distance_matrix[x, y]
+
+        tour.insert(int(np.argmin(insertion_costs)) + 1, node)
+
+    return tuple(tour)
+
+
+def improve_tour(distance_matrix, tour, time_budget=HEURISTIC_TSP_TIME_BUDGET):
+    """ Applies improving 2-opt and Or-opt moves to the tour until it is locally optimal or time_budget runs out. """
+
+    improved_tour = _improve_tour(np.asarray(distance_matrix), np.array(tour), time.time() + time_budget)
+
+    return tuple(int(node) for node in improved_tour)
+
+
+def get_tour_cost(distance_matrix, tour):
+    return _to_python_number(_get_tour_cost(np.asarray(distance_matrix), list(tour)))
+
+
+def get_one_tree_lower_bound(distance_matrix, source=0):
+    """
+    Returns the 1-tree lower bound on the optimal tour cost: the weight of the minimum spanning tree on every node but
+    the source, plus the two cheapest edges at the source.
+    """
+
+    distance_matrix = np.asarray(distance_matrix)
+    n = distance_matrix.shape[0]
+
+    if n <= 2:
+        return _to_python_number(2 * distance_matrix[source].max()) if n == 2 else 0
+
+    others = [node for node in range(n) if node != source]
+
+    # Prim's algorithm on the other nodes
+    others_distances = distance_matrix[np.ix_(others, others)]
+    in_tree = np.zeros(len(others), dtype=bool)
+    in_tree[0] = True
+    closest_tree_distances = others_distances[0].astype(float)
+
+    tree_weight = 0
+    for _ in range(len(others) - 1):
+        closest_tree_distances[in_tree] = np.inf
+        node = int(np.argmin(closest_tree_distances))
+
+        tree_weight += closest_tree_distances[node]
+        in_tree[node] = True
+        closest_tree_distances = np.minimum(closest_tree_distances, others_distances[node])
+
+    source_edges = np.sort(distance_matrix[source, others])
+
+    return _to_python_number(tree_weight + source_edges[0] + source_edges[1])
+
+
+def get_optimality_gap(cost, lower_bound):
+    """ Returns how much more the cost is than the lower bound, as a fraction of the lower bound. """
+    return (cost - lower_bound) / float(lower_bound) if lower_bound > 0 else 0.0
+
+
+def _to_python_number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _get_tour_cost(distance_matrix, tour):
+    return distance_matrix[tour[:-1], tour[1:]].sum()
+
+
+def _get_nearest_neighbor_tour(distance_matrix, source):
+    n = distance_matrix.shape[0]
+
+    is_visited = np.zeros(n, dtype=bool)
+    is_visited[source] = True
+
+    tour = [source]
+    for _ in range(n - 1):
+        distances = np.where(is_visited, np.inf, distance_matrix[tour[-1]])
+        node = int(np.argmin(distances))
+
+        tour.append(node)
+        is_visited[node] = True
+
+    tour.append(source)
+
+    return np.array(tour)
+
+
+def _perturb_tour(tour, random_state):
+    """ Applies a random double-bridge move, which 2-opt and Or-opt can't easily undo, to the tour. """
+
+    # Cut the inside of the tour into four parts A B C D and reconnect them as A C B D
+    i, j, k = sorted(random_state.choice(np.arange(2, len(tour) - 1), size=3, replace=False))
+
+    return np.concatenate((tour[:i], tour[j:k], tour[i:j], tour[k:]))
+
+
+def _improve_tour(distance_matrix, tour, deadline):
+    """ Applies improving 2-opt and Or-opt moves to the tour until there are none left or the deadline passes. """
+
+    tour = tour.copy()
+
+    is_improved = True
+    while is_improved and time.time() < deadline:
+        is_improved = _apply_two_opt_moves(distance_matrix, tour, deadline)
+        is_improved = _apply_or_opt_moves(distance_matrix, tour, deadline) or is_improved
+
+    return tour
+
+
+def _apply_two_opt_moves(distance_matrix, tour, deadline):
+    """ Reverses parts of the tour (in place) while that makes it cheaper. Returns whether the tour changed. """
+
+    is_improved = False
+
+    for i in range(len(tour) - 3):
+        if time.time() > deadline:
+            break
+
+        # Replace edges (a, b) and (c, d) with (a, c) and (b, d), for every later edge (c, d)
+        a, b = tour[i], tour[i + 1]
+        c, d = tour[i + 2:-1], tour[i + 3:]
+
+        deltas = distance_matrix[a, c] + distance_matrix[b, d] - distance_matrix[a, b] - distance_matrix[c, d]
+
+        best = int(np.argmin(deltas))
+        if deltas[best] < 0:
+            j = i + 2 + best
+            tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+            is_improved = True
+
+    return is_improved
+
+
+def _apply_or_opt_moves(distance_matrix, tour, deadline):
+    """
+    Moves runs of up to three consecutive nodes (in place) to a cheaper position in the tour, possibly reversed.
+    Returns whether the tour changed.
+    """
+
+    is_improved = False
+
+    for run_length in (1, 2, 3):
+        i = 1
+        while i + run_length < len(tour):
+            if time.time() > deadline:
+                return is_improved
+
+            run = tour[i:i + run_length]
+            previous_node, next_node = tour[i - 1], tour[i + run_length]
+
+            removal_gain = (distance_matrix[previous_node, run[0]] + distance_matrix[run[-1], next_node]
+                            - distance_matrix[previous_node, next_node])
+
+            # Every edge (x, y) of the tour without the run, where it could be inserted instead
+            rest = np.concatenate((tour[:i], tour[i + run_length:]))
+            x, y = rest[:-1], rest[1:]
+
+            insertion_costs = distance_matrix[x, run[0]] + distance_matrix[run[-1], y] - distance_matrix[x, y]
+            reversed_insertion_costs = distance_matrix[x, run[-1]] + distance_matrix[run[0], y] - distance_matrix[x, y]
+
+            best = int(np.argmin(insertion_costs))
+            best_reversed = int(np.argmin(reversed_insertion_costs))
+
+            if min(insertion_costs[best], reversed_insertion_costs[best_reversed]) < removal_gain:
+                if insertion_costs[best] <= reversed_insertion_costs[best_reversed]:
+                    position, inserted_run = best + 1, run
+                else:
+                    position, inserted_run = best_reversed + 1, run[::-1]
+
+                tour[:] = np.concatenate((rest[:position], inserted_run, rest[position:]))
+                is_improved = True
+
+            i += 1
+
+    return is_improved
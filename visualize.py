@@ -1,7 +1,8 @@
 import Tkinter as tk
 from constants import SHELVE_CELL, NAVIGABLE_CELL, OBSTACLE_CELL
 import utils
-import json
+import storage
+import argparse
 import os
 import logging
 import numpy as np
@@ -17,6 +18,12 @@ SQUARE_SIDE_LENGTH_PX = 15
 # The height of the text portion at the bottom of the Tkinter window
 TITLE_TEXT_HEIGHT = 30
 
+# Pick paths decoded ahead of time on either side of the one shown, so that Left/Right don't wait on the file
+PREFETCH_WINDOW = 2
+
+# Decoded pick paths kept in memory, enough for the prefetch window and some of the paths already seen
+PICK_PATH_CACHE_SIZE = 4 * PREFETCH_WINDOW + 1
+
 
 class Colors(str):
     """
@@ -46,10 +53,10 @@ def render():
     logger.info('Starting render.')
 
     # Rely on global variables that can be modified elsewhere
-    global gt_library_grid_warehouse, canvas_height, canvas_width, canvas, pick_paths, current_pick_path_index
+    global gt_library_grid_warehouse, canvas_height, canvas_width, canvas, current_pick_path_index
 
     # Get pick path to be rendered
-    pick_path = pick_paths[current_pick_path_index]
+    pick_path = get_pick_path(current_pick_path_index)
     ordered_pick_path = pick_path['pickPathInformation']['orderedPickPath']
 
     # Remove all elements added in previous calls to render
@@ -249,27 +256,65 @@ def transform(origin, point, theta):
     return tuple(point)
 
 
+def get_pick_path(pick_path_index):
+    """ Returns the pick path at the given position in pathId order, decoding it from the file unless it is cached. """
+
+    global pick_path_reader, pick_path_cache
+
+    path_id = pick_path_reader.path_ids[pick_path_index]
+
+    pick_path = pick_path_cache.get(path_id)
+    if pick_path is None:
+        pick_path = pick_path_reader.get(path_id)
+        pick_path_cache.put(path_id, pick_path)
+
+    return pick_path
+
+
+def prefetch_pick_paths():
+    """ Decodes the pick paths around the one shown, closest first, so they are cached before they are asked for. """
+
+    for distance in range(1, PREFETCH_WINDOW + 1):
+        for pick_path_index in (current_pick_path_index + distance, current_pick_path_index - distance):
+            if 0 <= pick_path_index < len(pick_path_reader):
+                get_pick_path(pick_path_index)
+
+    # The shown pick path stays the most recently used
+    get_pick_path(current_pick_path_index)
+
+
 def tk_handle_left_key(event):
     global current_pick_path_index
     current_pick_path_index = max(0, current_pick_path_index - 1)
 
-    logger.info("Left key pressed. Current pick path index set to %d." % current_pick_path_index)
+    logger.info("Left key pressed. Current pick path index set to %d.", current_pick_path_index)
 
     render()
+    tk_main.after_idle(prefetch_pick_paths)
 
 
 def tk_handle_right_key(event):
     global current_pick_path_index
-    current_pick_path_index = min(len(pick_paths) - 1, current_pick_path_index + 1)
+    current_pick_path_index = min(len(pick_path_reader) - 1, current_pick_path_index + 1)
 
-    logger.info("Right key pressed. Current pick path index set to %d." % current_pick_path_index)
+    logger.info("Right key pressed. Current pick path index set to %d.", current_pick_path_index)
 
     render()
+    tk_main.after_idle(prefetch_pick_paths)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Shows pick paths on the warehouse, Left/Right to go through them.')
+    parser.add_argument('pick_paths', nargs='?', default='pick-paths.json',
+                        help='Pick paths file: version %s JSON, JSON Lines or binary.' % PICK_PATH_FILE_FORMAT_VERSION)
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
     # Setup all global variables used by Tkinter callbacks later on
 
+    args = parse_args()
+
     global gt_library_grid_warehouse
     gt_library_grid_warehouse = utils.get_warehouse('warehouse.json')
 
@@ -285,23 +330,23 @@ if __name__ == '__main__':
     canvas.pack()
     canvas.master.title("Sparse AR - Pick Path Visualization - v%s" % PICK_PATH_FILE_FORMAT_VERSION)
 
-    # Setup pick paths, showing the first one
-
-    with open('pick-paths.json', mode='r') as f:
-        pick_path_data = json.load(f)
+    # Setup pick paths, showing the first one. Only the index of the file is read up front, pick paths are decoded
+    # as they are shown
 
-    assert pick_path_data['version'] == PICK_PATH_FILE_FORMAT_VERSION
-
-    global pick_paths, current_pick_path_index
-    pick_paths = pick_path_data['pickPaths']
+    global pick_path_reader, pick_path_cache, current_pick_path_index
+    pick_path_reader = storage.open_pick_path_file(args.pick_paths, save_index=True)
+    pick_path_cache = utils.LRUCache(PICK_PATH_CACHE_SIZE)
     current_pick_path_index = 0
 
+    assert len(pick_path_reader) > 0, "No pick paths in %s" % args.pick_paths
+
     # Bind Left/Right keypress events to the corresponding functions
     tk_main.bind('<Left>', tk_handle_left_key)
     tk_main.bind('<Right>', tk_handle_right_key)
 
     # Render the first pick path
     render()
+    tk_main.after_idle(prefetch_pick_paths)
 
     # Run Tkinter forever
     tk_main.mainloop()